@@ -0,0 +1,116 @@
+"""Generator for synthetic unittest modules, used as the benchmark corpus."""
+
+from __future__ import annotations
+
+import argparse
+import random
+
+REWRITABLE_ASSERTIONS = [
+    ("assertTrue", "{a} == {b}"),
+    ("assertTrue", "{a} in {b}"),
+    ("assertTrue", "len({a}) >= {n}"),
+    ("assertFalse", "{a} is None"),
+    ("assertFalse", "isinstance({a}, {cls})"),
+    ("assertIs", "{a}, None"),
+    ("assertIs", "{a}, True"),
+    ("failUnless", "{a} != {b}"),
+    ("assertEquals", "{a}, {b}"),
+]
+
+OTHER_STATEMENTS = [
+    "self.assertEqual({a}, {b})",
+    "self.assertRaises(ValueError, {a})",
+    "{a} = {b}.copy()",
+    "{a} = [{n}, {n}, {n}]",
+    "{a}.update({b})",
+]
+
+NAMES = ["value", "result", "expected", "items", "payload", "response", "obj"]
+CLASSES = ["int", "str", "dict", "list", "Exception"]
+
+
+def _fill(template, rng):
+    return template.format(
+        a=rng.choice(NAMES),
+        b=rng.choice(NAMES),
+        n=rng.randint(0, 100),
+        cls=rng.choice(CLASSES),
+    )
+
+
+def _comment(rng):
+    return f"# note {rng.randint(0, 1000)}"
+
+
+def _assertion(rng, indent, multi_line_ratio, comment_density):
+    method, template = rng.choice(REWRITABLE_ASSERTIONS)
+    arguments = [_fill(template, rng)]
+    if rng.random() < 0.3:
+        arguments.append(repr(f"message {rng.randint(0, 1000)}"))
+
+    if rng.random() < multi_line_ratio:
+        lines = [f"{indent}self.{method}("]
+        for index, argument in enumerate(arguments):
+            line = f"{indent}    {argument}"
+            if index + 1 != len(arguments):
+                line += ","
+            if rng.random() < comment_density:
+                line += " " + _comment(rng)
+            lines.append(line)
+        lines.append(f"{indent})")
+        return lines
+
+    line = f"{indent}self.{method}({', '.join(arguments)})"
+    if rng.random() < comment_density:
+        line += " " + _comment(rng)
+    return [line]
+
+
+def generate_module(
+    statements=1000,
+    *,
+    assertion_density=0.3,
+    multi_line_ratio=0.2,
+    comment_density=0.1,
+    statements_per_method=10,
+    seed=0,
+):
+    """Generate the source of a test module with the given number of
+    statements. ``assertion_density`` is the share of statements that
+    are assertions teyit would rewrite, ``multi_line_ratio`` is the share
+    of those that span multiple lines and ``comment_density`` is the
+    chance of a line having a trailing comment."""
+
+    rng = random.Random(seed)
+    lines = ["import unittest", "", "", "class GeneratedTestCase(unittest.TestCase):"]
+    for index in range(statements):
+        if index % statements_per_method == 0:
+            lines.extend(["", f"    def test_{index // statements_per_method}(self):"])
+
+        indent = " " * 8
+        if rng.random() < assertion_density:
+            lines.extend(_assertion(rng, indent, multi_line_ratio, comment_density))
+        else:
+            line = indent + _fill(rng.choice(OTHER_STATEMENTS), rng)
+            if rng.random() < comment_density:
+                line += " " + _comment(rng)
+            lines.append(line)
+
+    if statements == 0:
+        lines.append("    pass")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--statements", type=int, default=1000)
+    parser.add_argument("--assertion-density", type=float, default=0.3)
+    parser.add_argument("--multi-line-ratio", type=float, default=0.2)
+    parser.add_argument("--comment-density", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+    print(generate_module(**vars(options)), end="")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""Benchmarks for teyit's rewriting pipeline.
+
+Times each phase of ``rewrite_source`` on a synthetic corpus, and checks
+that both the runtime and the peak memory grow linearly with the file
+size and with the number of rewrites. Results are written as JSON, and
+two such results (e.g. from different commits) can be compared with
+``--compare``. Everything runs offline, on generated sources."""
+
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+sys.path[:0] = [str(ROOT), str(ROOT.parent)]
+
+from generate import generate_module  # noqa: E402
+
+import teyit  # noqa: E402
+
+PHASES = ("parse", "visit", "tokenize", "unparse", "splice")
+
+
+def time_phases(source):
+    """Run ``teyit.rewrite_source`` once, and return the time
+    spent in each of its phases."""
+
+    teyit._RENDER_CACHE.clear()
+    timings = teyit._Timings()
+    _, rewrites = teyit.rewrite_source(source, timings=timings)
+    return dict(timings.phases), len(rewrites)
+
+
+def best_phases(source, repeat):
+    best = dict.fromkeys(PHASES, math.inf)
+    for _ in range(repeat):
+        timings, rewrite_count = time_phases(source)
+        for phase in PHASES:
+            best[phase] = min(best[phase], timings.get(phase, 0.0))
+    return best, rewrite_count
+
+
+def measure(source, repeat):
+    durations = []
+    for _ in range(repeat):
+        # Only the repetitions within the source should hit the cache.
+        teyit._RENDER_CACHE.clear()
+        start = time.perf_counter()
+        _, rewrites = teyit.rewrite_source(source)
+        durations.append(time.perf_counter() - start)
+
+    teyit._RENDER_CACHE.clear()
+    tracemalloc.start()
+    try:
+        teyit.rewrite_source(source)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(durations), peak_memory, len(rewrites)
+
+
+def _exponent(xs, ys):
+    # Slope of the least squares fit on a log-log scale; 1.0 means
+    # linear growth, 2.0 means quadratic.
+    log_xs = [math.log(x) for x in xs]
+    log_ys = [math.log(y) for y in ys]
+    mean_x = sum(log_xs) / len(log_xs)
+    mean_y = sum(log_ys) / len(log_ys)
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in zip(log_xs, log_ys))
+    variance = sum((x - mean_x) ** 2 for x in log_xs)
+    return covariance / variance
+
+
+def scaling_series(sources, key, repeat):
+    points = []
+    for source in sources:
+        duration, peak_memory, rewrite_count = measure(source, repeat)
+        points.append(
+            {
+                "lines": source.count("\n"),
+                "bytes": len(source.encode()),
+                "rewrites": rewrite_count,
+                "seconds": duration,
+                "peak_memory": peak_memory,
+            }
+        )
+
+    xs = [point[key] for point in points]
+    return {
+        "points": points,
+        "time_exponent": _exponent(xs, [point["seconds"] for point in points]),
+        "memory_exponent": _exponent(xs, [point["peak_memory"] for point in points]),
+    }
+
+
+def _git_revision():
+    try:
+        process = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return process.stdout.strip()
+
+
+def run_benchmarks(options):
+    corpus_options = dict(
+        assertion_density=options.assertion_density,
+        multi_line_ratio=options.multi_line_ratio,
+        comment_density=options.comment_density,
+        seed=options.seed,
+    )
+    source = generate_module(options.statements, **corpus_options)
+    phases, rewrite_count = best_phases(source, options.repeat)
+
+    factors = [2**power for power in range(options.steps)]
+    base_size = max(1, options.statements // factors[-1])
+    size_series = scaling_series(
+        [generate_module(base_size * factor, **corpus_options) for factor in factors],
+        key="bytes",
+        repeat=options.repeat,
+    )
+
+    base_density = options.assertion_density / factors[-1]
+    rewrite_series = scaling_series(
+        [
+            generate_module(
+                options.statements,
+                **{**corpus_options, "assertion_density": base_density * factor},
+            )
+            for factor in factors
+        ],
+        key="rewrites",
+        repeat=options.repeat,
+    )
+
+    limit = 1 + options.tolerance
+    checks = {
+        "time_grows_linearly_with_size": size_series["time_exponent"] <= limit,
+        "memory_grows_linearly_with_size": size_series["memory_exponent"] <= limit,
+        "time_grows_linearly_with_rewrites": rewrite_series["time_exponent"] <= limit,
+        "memory_grows_linearly_with_rewrites": (
+            rewrite_series["memory_exponent"] <= limit
+        ),
+    }
+    return {
+        "metadata": {
+            "teyit": teyit.__version__,
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+        },
+        "corpus": {"statements": options.statements, **corpus_options},
+        "phases": {"rewrites": rewrite_count, "seconds": phases},
+        "scaling": {"size": size_series, "rewrites": rewrite_series},
+        "checks": checks,
+    }
+
+
+def compare(baseline_file, current_file, threshold):
+    baseline = json.loads(Path(baseline_file).read_text())
+    current = json.loads(Path(current_file).read_text())
+
+    regressions = 0
+    print(f"{'phase':10} {'baseline':>12} {'current':>12} {'change':>8}")
+    for phase in PHASES:
+        before = baseline["phases"]["seconds"][phase]
+        after = current["phases"]["seconds"][phase]
+        change = (after - before) / before if before else 0.0
+        marker = ""
+        if change > threshold:
+            regressions += 1
+            marker = " (regression)"
+        print(
+            f"{phase:10} {before * 1000:10.2f}ms {after * 1000:10.2f}ms"
+            f" {change:+8.1%}{marker}"
+        )
+
+    for series in ("size", "rewrites"):
+        for metric in ("time_exponent", "memory_exponent"):
+            print(
+                f"{series} {metric}: {baseline['scaling'][series][metric]:.2f}"
+                f" => {current['scaling'][series][metric]:.2f}"
+            )
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--statements", type=int, default=2000)
+    parser.add_argument("--assertion-density", type=float, default=0.4)
+    parser.add_argument("--multi-line-ratio", type=float, default=0.2)
+    parser.add_argument("--comment-density", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of runs per measurement"
+    )
+    parser.add_argument(
+        "--steps",
+        type=int,
+        default=4,
+        help="Number of points (doubling each time) in the scaling series",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed excess over a linear growth exponent of 1.0",
+    )
+    parser.add_argument("-o", "--output", type=Path, help="Write the results here")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASELINE", "CURRENT"),
+        help="Compare two result files instead of running the benchmarks",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Slowdown ratio of a phase that counts as a regression in --compare",
+    )
+    options = parser.parse_args()
+
+    if options.compare:
+        raise SystemExit(compare(*options.compare, threshold=options.threshold))
+
+    results = run_benchmarks(options)
+    report = json.dumps(results, indent=2)
+    if options.output:
+        options.output.write_text(report + "\n")
+    else:
+        print(report)
+
+    failed_checks = [name for name, passed in results["checks"].items() if not passed]
+    for name in failed_checks:
+        print(f"check failed: {name}", file=sys.stderr)
+    raise SystemExit(1 if failed_checks else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,33 @@
 from __future__ import annotations
 
 import ast
+import gc
+import io
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from contextlib import redirect_stderr, redirect_stdout, suppress
 from pathlib import Path
+from unittest import mock
 
 import teyit
+import teyitd
 
 TEST_DATA_DIR = Path(__file__).parent
 
+# Seconds that importing teyit may take at most. A cold import used to
+# be ~0.1s on a developer machine (mostly spent importing refactor); it
+# is now ~0.03s.
+IMPORT_TIME_BUDGET = 0.08
+
 
 class TeyitTestCase(unittest.TestCase):
     def assertRewrites(self, given, expected, case_count=None, **kwargs):
@@ -43,6 +63,275 @@ class TeyitTestCase(unittest.TestCase):
         rewrite = teyit.Rewrite(func, "assertIsNone", [func.args[0]])
         self.assertEqual(rewrite.get_arg_offset(), -1)
 
+    def test_line_endings(self):
+        self.assertRewrites(
+            "self.assertTrue(x == y)\r\nself.assertTrue(\r\n    x in y,  # c\r\n)\r\n",
+            "self.assertEqual(x, y)\r\nself.assertIn(\r\n    x,\r\n    y # c\r\n)\r\n",
+        )
+        self.assertRewrites(
+            "self.assertTrue(x == y)\rself.assertIs(x, None)\r",
+            "self.assertEqual(x, y)\rself.assertIsNone(x)\r",
+        )
+        self.assertRewrites(
+            "self.assertTrue(x == y)\r\nself.assertTrue(x != y)\n",
+            "self.assertEqual(x, y)\r\nself.assertNotEqual(x, y)\n",
+        )
+        # Form feeds and other characters that str.splitlines() would split
+        # on don't shift the lines.
+        self.assertRewrites(
+            "x = 1\n\x0c\nself.assertTrue(x == y)\nz = '\u2028'\nself.assertIs(x,"
+            " None)\n",
+            "x = 1\n\x0c\nself.assertEqual(x, y)\nz = '\u2028'\nself.assertIsNone(x)\n",
+        )
+
+    def test_refactor_file_io(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base = Path(tmp_dir)
+            files = {
+                "test_crlf.py": (
+                    b"self.assertTrue(x == y)\r\nx = 1\r\n",
+                    b"self.assertEqual(x, y)\r\nx = 1\r\n",
+                ),
+                "test_latin1.py": (
+                    b"# -*- coding: latin-1 -*-\nself.assertTrue(x == '\xe7')\n",
+                    b"# -*- coding: latin-1 -*-\nself.assertEqual(x, '\xe7')\n",
+                ),
+                "test_bom.py": (
+                    b"\xef\xbb\xbfself.assertTrue(x is None)",
+                    b"\xef\xbb\xbfself.assertIsNone(x)",
+                ),
+            }
+            for name, (source, _) in files.items():
+                (base / name).write_bytes(source)
+                (base / name).chmod(0o640)
+
+            with redirect_stdout(io.StringIO()):
+                teyit._refactor_files([base], pattern="test_*.py", cache=False, jobs=1)
+            for name, (_, expected) in files.items():
+                self.assertEqual((base / name).read_bytes(), expected)
+                self.assertEqual((base / name).stat().st_mode & 0o777, 0o640)
+            self.assertEqual(sorted(os.listdir(base)), sorted(files))
+
+            # A failing write leaves the original file (and no temporary
+            # files) behind.
+            (base / "test_crlf.py").write_bytes(b"self.assertTrue(x)\r\n")
+            with mock.patch.object(os, "replace", side_effect=OSError("disk full")):
+                with self.assertRaises(OSError):
+                    teyit._write_atomic(base / "test_crlf.py", b"broken")
+            self.assertEqual(
+                (base / "test_crlf.py").read_bytes(), b"self.assertTrue(x)\r\n"
+            )
+            self.assertEqual(sorted(os.listdir(base)), sorted(files))
+
+    def test_render_from_source(self):
+        # The arguments are copied from the source as is (including their
+        # formatting and comments), without going through the unparser.
+        with mock.patch.object(teyit, "_get_unparser") as get_unparser:
+            self.assertRewrites(
+                "self.assertTrue(x == {\n    'a': [1,2],  # comment\n})",
+                "self.assertEqual(\n    x,\n    {\n    'a': [1,2],  # comment\n}\n)",
+            )
+            self.assertRewrites(
+                'self.assertTrue("ç" == "ğ", msg = "ü")',
+                'self.assertEqual("ç", "ğ", msg="ü")',
+            )
+        get_unparser.assert_not_called()
+
+        # Only the synthesized nodes are unparsed.
+        self.assertRewrites(
+            "self.assertDictContainsSubset({'a': 1}, {\n    'b': 2,\n})",
+            "self.assertEqual(\n    {\n    'b': 2,\n},\n    {**{\n    'b': 2,\n},"
+            " **{'a': 1}}\n)",
+        )
+
+    def test_render_cache(self):
+        source = (
+            "def test(self):\n"
+            "    self.assertTrue(x is None)\n"
+            "    self.assertTrue(x is None)  # comment\n"
+            "    if x:\n"
+            "        self.assertTrue(x is None)\r\n"
+            "    self.assertTrue(x is None)\n"
+            "    self.assertTrue(\n"
+            "        x is None,  # comment\n"
+            "    )\n"
+            "    self.assertTrue(x is None)\n"
+        )
+        expected_source = (
+            "def test(self):\n"
+            "    self.assertIsNone(x)\n"
+            "    self.assertIsNone(x) # comment\n"
+            "    if x:\n"
+            "        self.assertIsNone(x)\r\n"
+            "    self.assertIsNone(x)\n"
+            "    self.assertIsNone(\n"
+            "        x # comment\n"
+            "    )\n"
+            "    self.assertIsNone(x)\n"
+        )
+        render_cache = teyit._RenderCache(maxsize=2)
+        with mock.patch.object(teyit, "_RENDER_CACHE", render_cache):
+            self.assertEqual(teyit.refactor(source), expected_source)
+            self.assertEqual((render_cache.hits, render_cache.misses), (1, 5))
+            self.assertEqual(
+                teyit.refactor(source, blacklist=frozenset({"assertIs"})),
+                expected_source,
+            )
+            self.assertEqual((render_cache.hits, render_cache.misses), (2, 10))
+            self.assertEqual(len(render_cache._entries), 2)
+
+    def test_scope(self):
+        source = (
+            "DATA = [{'id': 1}, {'id': 2}]\n"
+            "def helper(self):\n"
+            "    self.assertTrue(a == b)\n"
+            "class Mixin:\n"
+            "    value = self.assertTrue(a == b)\n"
+            "    def test_mixin(self):\n"
+            "        self.assertTrue(a == b)\n"
+            "if sys.platform:\n"
+            "    class T(unittest.TestCase):\n"
+            "        def test(self):\n"
+            "            expected = [\n"
+            "                {'id': 1},\n"
+            "                self.assertTrue(a == b)\n"
+            "            ]\n"
+            "            with x:\n"
+            "                self.assertTrue(a == b)\n"
+            "        class Nested(TestCase):\n"
+            "            def test(self):\n"
+            "                self.assertTrue(a == b)\n"
+        )
+
+        def rewritten_lines(scope):
+            return [
+                source.count("\n", 0, edit.start) + 1
+                for edit in teyit.analyze(source, scope=scope)
+            ]
+
+        self.assertEqual(rewritten_lines("module"), [3, 7, 13, 16, 19])
+        self.assertEqual(rewritten_lines("classes"), [7, 13, 16, 19])
+        self.assertEqual(rewritten_lines("testcases"), [13, 16, 19])
+        self.assertNotIn("Module", teyit.RULES)
+
+        conditional_source = (
+            "match sys.platform:\n"
+            "    case 'linux':\n"
+            "        class T(unittest.TestCase):\n"
+            "            if sys.version_info >= (3, 8):\n"
+            "                def test(self):\n"
+            "                    self.assertTrue(a == b)\n"
+            "            try:\n"
+            "                import x\n"
+            "            except ImportError:\n"
+            "                pass\n"
+            "            else:\n"
+            "                def test_x(self):\n"
+            "                    self.assertTrue(a == b)\n"
+        )
+        for scope in teyit.SCOPES:
+            self.assertEqual(
+                teyit.refactor(conditional_source, scope=scope),
+                conditional_source.replace(
+                    "self.assertTrue(a == b)", "self.assertEqual(a, b)"
+                ),
+            )
+
+        for case in (TEST_DATA_DIR / "cosmetic").iterdir():
+            for scope in teyit.SCOPES:
+                self.assertEqual(
+                    teyit.refactor((case / "input.py").read_text(), scope=scope),
+                    (case / "output.py").read_text(),
+                )
+
+    def test_analyze(self):
+        source = (
+            "def test(self):\n"
+            "    self.assertTrue(x == y)\n"
+            "    x = 1\n"
+            "    self.failUnless(\n"
+            "        x in y,  # comment\n"
+            "    )\n"
+        )
+        tree = ast.parse(source)
+        tree_dump = ast.dump(tree, include_attributes=True)
+        with mock.patch.object(ast, "parse", wraps=ast.parse) as parse:
+            edits = teyit.analyze(source, tree)
+        self.assertNotIn(mock.call(source), parse.call_args_list)
+        self.assertEqual(ast.dump(tree, include_attributes=True), tree_dump)
+
+        self.assertEqual(
+            edits,
+            [
+                teyit.Edit(16, 44, "    self.assertEqual(x, y)\n", "assertTrue"),
+                teyit.Edit(
+                    54,
+                    108,
+                    "    self.assertIn(\n        x,\n        y # comment\n    )\n",
+                    "failUnless",
+                ),
+            ],
+        )
+        self.assertEqual(source[16:44], "    self.assertTrue(x == y)\n")
+
+        new_source = source
+        for start, end, replacement, _ in reversed(edits):
+            new_source = new_source[:start] + replacement + new_source[end:]
+        self.assertEqual(new_source, teyit.refactor(source))
+
+        self.assertEqual(
+            teyit.analyze(source, blacklist={"assertTrue"})[0].rule, "failUnless"
+        )
+        self.assertEqual(teyit.analyze("x = 1\n"), [])
+        self.assertEqual(teyit.analyze(""), [])
+
+    def test_refactor_many(self):
+        self.assertEqual(
+            list(
+                teyit.refactor_many(
+                    ["self.assertTrue(x == y)\n", "x = 1\n", "self.assertIs(x, None)"],
+                    blacklist={"assertIs"},
+                )
+            ),
+            ["self.assertEqual(x, y)\n", "x = 1\n", "self.assertIs(x, None)"],
+        )
+
+    def test_rewrite_release(self):
+        source, rewrites = teyit.refactor_until_deterministic(
+            "self.assertTrue(x == y)\nself.assertFalse(x is None)\n"
+        )
+        self.assertEqual(source, "self.assertEqual(x, y)\nself.assertIsNotNone(x)\n")
+        for rewrite in rewrites:
+            self.assertFalse(hasattr(rewrite, "__dict__"))
+            self.assertIsNone(rewrite.node)
+            self.assertIsNone(rewrite.args)
+        self.assertEqual(
+            [(rewrite.original_func, rewrite.func) for rewrite in rewrites],
+            [("assertTrue", "assertEqual"), ("assertFalse", "assertIsNotNone")],
+        )
+
+    def test_refactor_files_memory(self):
+        def live_objects():
+            gc.collect()
+            return sum(
+                isinstance(obj, (teyit.Rewrite, ast.AST)) for obj in gc.get_objects()
+            )
+
+        source = "\n".join(
+            f"self.assertTrue(x{index} == y{index})" for index in range(20)
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base = Path(tmp_dir)
+            for index in range(20):
+                (base / f"test_{index}.py").write_text(source)
+
+            # Nothing from the already processed files (neither the trees,
+            # nor the rewrites) should be kept alive until the end of the run.
+            before = live_objects()
+            with redirect_stdout(io.StringIO()):
+                teyit._refactor_files([base], pattern="test_*.py", cache=False, jobs=1)
+            self.assertEqual(live_objects(), before)
+
     def test_assert_rewriter_basic(self):
         self.assertRewrites("self.assertTrue(x == y)", "self.assertEqual(x, y)")
         self.assertRewrites("self.assertTrue(x != y)", "self.assertNotEqual(x, y)")
@@ -97,6 +386,57 @@ class TeyitTestCase(unittest.TestCase):
             "self.assertNotIsInstance(x, T)",
         )
 
+    def test_assert_rewriter_single_pass(self):
+        for given, expected in [
+            ("self.failUnless(x == y)", "self.assertEqual(x, y)"),
+            ("self.failIf(x is None)", "self.assertIsNotNone(x)"),
+            ("self.assert_(isinstance(x, T), msg)", "self.assertIsInstance(x, T, msg)"),
+            ("self.assertIs(x is y, True)", "self.assertIs(x, y)"),
+            ("self.assertIs(x in y, False)", "self.assertNotIn(x, y)"),
+        ]:
+            with self.subTest(given=given):
+                source, rewrites = teyit.rewrite_source(given)
+                self.assertEqual(source, expected)
+                self.assertEqual(len(rewrites), 1)
+
+        source, _ = teyit.rewrite_source(
+            "self.failUnless(x == y)", blacklist=frozenset({"assertTrue"})
+        )
+        self.assertEqual(source, "self.assertTrue(x == y)")
+
+    def test_rule_selection(self):
+        self.assertIn("assertTrue", teyit.RULES)
+        self.assertIn("failUnless", teyit.RULES)
+        self.assertEqual(
+            teyit._get_blacklist(select=[{"assertTrue"}, {"assertIs"}]),
+            teyit.RULES.keys() - {"assertTrue", "assertIs"},
+        )
+        self.assertEqual(
+            teyit._get_blacklist(ignore=[{"assertTrue", "assertIs"}]),
+            {"assertTrue", "assertIs"},
+        )
+        self.assertEqual(
+            teyit._get_blacklist(
+                select=[{"assertTrue", "assertIs"}], ignore=[{"assertIs"}]
+            ),
+            teyit.RULES.keys() - {"assertTrue"},
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test_file = Path(tmp_dir) / "test_rules.py"
+            test_file.write_text("self.assertTrue(x == y)\nself.assertIs(x, None)\n")
+            with redirect_stdout(io.StringIO()):
+                teyit._refactor_files(
+                    [test_file],
+                    pattern="test_*.py",
+                    cache=False,
+                    blacklist=frozenset({"assertIs"}),
+                )
+            self.assertEqual(
+                test_file.read_text(),
+                "self.assertEqual(x, y)\nself.assertIs(x, None)\n",
+            )
+
     def test_assert_rewriter_deprecated(self):
         # Regenerate tests
         # template = "self.{key}(x, y, z, msg=msg)"
@@ -174,6 +514,940 @@ class TeyitTestCase(unittest.TestCase):
                 case=case,
             )
 
+    def test_rewrite_source_scaling(self):
+        def best_time(count):
+            source = "class T:\n    def test(self):\n"
+            source += "        self.assertTrue(x == y)\n" * count
+            timings = []
+            for _ in range(3):
+                start = time.perf_counter()
+                _, rewrites = teyit.rewrite_source(source)
+                timings.append(time.perf_counter() - start)
+            self.assertEqual(len(rewrites), count)
+            return min(timings)
+
+        # 8 times more rewrites, where a quadratic engine would be ~64 times
+        # slower.
+        self.assertLess(best_time(1200) / best_time(150), 20)
+
+    def test_rewrite_source_shared_lines(self):
+        self.assertNotRewrites("x = self.assertTrue(a == b)")
+        self.assertNotRewrites("self.assertTrue(a == b); self.assertTrue(c == d)")
+        self.assertRewrites(
+            "if x:\n    self.assertTrue(a == b)  # comment\nz = 1\n",
+            "if x:\n    self.assertEqual(a, b) # comment\nz = 1\n",
+        )
+
+    def test_recover_comments(self):
+        source = (
+            "self.assertTrue(\n    x == y, # first\n\n    'message' # second\n)\n" * 3
+        )
+        expected = (
+            "self.assertEqual(\n    x, # first\n    y,\n    'message' # second\n)\n" * 3
+        )
+        with mock.patch.object(
+            teyit.tokenize, "generate_tokens", wraps=teyit.tokenize.generate_tokens
+        ) as generate_tokens:
+            self.assertEqual(teyit.rewrite_source(source)[0], expected)
+        self.assertEqual(generate_tokens.call_count, 1)
+
+    def test_refactor_files_parallel(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base = Path(tmp_dir)
+
+            def run(jobs):
+                for index in range(8):
+                    (base / f"test_{index}.py").write_text(
+                        "self.assertTrue(x == y)\n" * index
+                    )
+                buffer = io.StringIO()
+                with redirect_stdout(buffer):
+                    status = teyit._refactor_files(
+                        [base],
+                        pattern="test_*.py",
+                        fail_on_change=True,
+                        jobs=jobs,
+                        cache=False,
+                    )
+                return status, buffer.getvalue()
+
+            sequential_status, sequential_output = run(jobs=1)
+            parallel_status, parallel_output = run(jobs=4)
+
+            self.assertEqual(sequential_status, 1)
+            self.assertEqual(parallel_status, sequential_status)
+            self.assertEqual(parallel_output, sequential_output)
+            self.assertIn("7 reformatted, 1 left unchanged", parallel_output)
+            self.assertEqual(
+                (base / "test_2.py").read_text(), "self.assertEqual(x, y)\n" * 2
+            )
+
+    def test_prefilter(self):
+        pattern = teyit._prefilter_pattern()
+        self.assertIsNotNone(pattern.search(b"self.assertTrue(x)"))
+        self.assertIsNotNone(pattern.search(b"self.failUnless(x)"))
+        self.assertIsNone(pattern.search(b"self.assertEqual(x, y)"))
+        self.assertIsNone(pattern.search(b"self.assertTrueish(x)"))
+        self.assertIsNone(
+            teyit._prefilter_pattern(frozenset({"assertTrue"})).search(
+                b"self.assertTrue(x)"
+            )
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base = Path(tmp_dir)
+            (base / "test_clean.py").write_text("self.assertEqual(x, y)\n")
+            (base / "test_dirty.py").write_text("self.assertTrue(x == y)\n")
+            buffer = io.StringIO()
+            with redirect_stdout(buffer):
+                teyit._refactor_files(
+                    [base], pattern="test_*.py", show_stats=True, cache=False
+                )
+            self.assertIn(
+                "1 files have been skipped without parsing", buffer.getvalue()
+            )
+
+    def test_stats(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base = Path(tmp_dir)
+            (base / "test_clean.py").write_text("self.assertEqual(x, y)\n")
+            (base / "test_dirty.py").write_text(
+                "self.assertTrue(x == y)\nself.failUnless(x is None)\n"
+            )
+
+            collected_stats = []
+            stdout, stderr = io.StringIO(), io.StringIO()
+            with mock.patch.object(teyit, "_STATS_HOOKS", []), mock.patch.object(
+                teyit, "_RENDER_CACHE", teyit._RenderCache()
+            ), redirect_stdout(stdout), redirect_stderr(stderr):
+                teyit.register_stats_hook(collected_stats.append)
+                teyit._refactor_files(
+                    [base], pattern="test_*.py", cache=False, stats_format="json"
+                )
+
+        [stats] = collected_stats
+        self.assertEqual(
+            stats["files"],
+            {
+                "total": 2,
+                "reformatted": 1,
+                "prefiltered": 1,
+                "cached": 0,
+                "too_large": 0,
+                "timed_out": 0,
+            },
+        )
+        self.assertEqual(
+            [(rule["from"], rule["to"], rule["count"]) for rule in stats["rules"]],
+            [("assertTrue", "assertEqual", 1), ("failUnless", "assertIsNone", 1)],
+        )
+        self.assertEqual(stats["render_cache"], {"hits": 0, "misses": 2})
+        self.assertTrue(
+            {"read", "parse", "visit", "tokenize", "unparse", "write"}.issubset(
+                stats["phases"]
+            )
+        )
+        self.assertEqual(
+            [Path(entry["path"]).name for entry in stats["slowest_files"]],
+            ["test_dirty.py", "test_clean.py"],
+        )
+
+        # Only the stats go to stdout, so that it can be parsed as is.
+        self.assertEqual(json.loads(stdout.getvalue()), stats)
+        self.assertIn("reformatted", stderr.getvalue())
+
+    def test_glob_match(self):
+        self.assertTrue(teyit._glob_match(("test_a.py",), ("test_*.py",)))
+        self.assertFalse(teyit._glob_match(("sub", "test_a.py"), ("test_*.py",)))
+        self.assertTrue(teyit._glob_match(("sub", "test_a.py"), ("**", "test_*.py")))
+        self.assertTrue(teyit._glob_match(("test_a.py",), ("**", "test_*.py")))
+        self.assertFalse(teyit._glob_match(("a.py",), ("**", "test_*.py")))
+
+    def test_glob_files_excludes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base = Path(tmp_dir)
+            for name in [
+                "test_a.py",
+                "sub/test_b.py",
+                "sub/test_b.log",
+                ".venv/lib/test_c.py",
+                "build/test_d.py",
+                "generated/test_e.py",
+                "sub/generated/test_f.py",
+                "sub/snapshots/test_g.py",
+                "sub/snapshots/test_keep.py",
+            ]:
+                (base / name).parent.mkdir(parents=True, exist_ok=True)
+                (base / name).touch()
+            (base / ".gitignore").write_text("generated/\n*.log\n")
+            (base / "sub" / ".gitignore").write_text("snapshots/*\n!test_keep.py\n")
+
+            def glob_files(**kwargs):
+                return sorted(
+                    path.relative_to(base).as_posix()
+                    for path in teyit._glob_files([base], "**/test_*.py", **kwargs)
+                )
+
+            default_excludes = re.compile(teyit.DEFAULT_EXCLUDES)
+            self.assertEqual(
+                glob_files(excludes=[default_excludes]),
+                ["sub/snapshots/test_keep.py", "sub/test_b.py", "test_a.py"],
+            )
+            self.assertEqual(
+                glob_files(excludes=[default_excludes, re.compile(r"/sub/")]),
+                ["test_a.py"],
+            )
+            self.assertEqual(
+                glob_files(excludes=[default_excludes], gitignore=False),
+                [
+                    "generated/test_e.py",
+                    "sub/generated/test_f.py",
+                    "sub/snapshots/test_g.py",
+                    "sub/snapshots/test_keep.py",
+                    "sub/test_b.py",
+                    "test_a.py",
+                ],
+            )
+            self.assertEqual(len(glob_files(gitignore=False)), 8)
+
+            # The .gitignore files above the given directory are respected
+            # as well, up to the root of the repository.
+            (base / ".git").mkdir()
+            self.assertEqual(
+                sorted(
+                    path.name
+                    for path in teyit._glob_files(
+                        [base / "sub"], "**/test_*.py", excludes=[default_excludes]
+                    )
+                ),
+                ["test_b.py", "test_keep.py"],
+            )
+
+    def test_file_budgets(self):
+        source = "self.assertTrue(x == y)\n"
+        slow_source = "self.assertTrue(slow == y)\n"
+        original_refactor = teyit._refactor_source
+
+        def refactor_source(source, *args, **kwargs):
+            if "slow" in source:
+                time.sleep(5)
+            return original_refactor(source, *args, **kwargs)
+
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs), tempfile.TemporaryDirectory() as tmp:
+                base = Path(tmp)
+                for name in ("test_a.py", "test_c.py"):
+                    (base / name).write_text(source)
+                (base / "test_b.py").write_text(slow_source)
+                (base / "test_big.py").write_text(
+                    "self.assertTrue(big_value == other_value)\n"
+                )
+
+                collected_stats = []
+                stdout, stderr = io.StringIO(), io.StringIO()
+                with mock.patch.object(
+                    teyit, "_refactor_source", refactor_source
+                ), mock.patch.object(teyit, "_STATS_HOOKS", []), redirect_stdout(
+                    stdout
+                ), redirect_stderr(
+                    stderr
+                ):
+                    teyit.register_stats_hook(collected_stats.append)
+                    started = time.perf_counter()
+                    teyit._refactor_files(
+                        [base],
+                        pattern="test_*.py",
+                        cache=False,
+                        jobs=jobs,
+                        max_file_size=30,
+                        timeout=0.2,
+                        stats_format="json",
+                    )
+                    self.assertLess(time.perf_counter() - started, 4)
+
+                self.assertEqual((base / "test_b.py").read_text(), slow_source)
+                for name in ("test_a.py", "test_c.py"):
+                    self.assertEqual(
+                        (base / name).read_text(), "self.assertEqual(x, y)\n"
+                    )
+                self.assertEqual(
+                    (base / "test_big.py").read_text(),
+                    "self.assertTrue(big_value == other_value)\n",
+                )
+
+                [stats] = collected_stats
+                self.assertEqual(stats["files"]["timed_out"], 1)
+                self.assertEqual(stats["files"]["too_large"], 1)
+                self.assertEqual(stats["files"]["reformatted"], 2)
+                self.assertEqual(json.loads(stdout.getvalue())["files"], stats["files"])
+                output = stderr.getvalue()
+                self.assertIn("test_b.py (took longer than 0.2s)", output)
+                self.assertIn("test_big.py (larger than 30 bytes)", output)
+                self.assertIn("2 reformatted, 1 timed out, 1 too large", output)
+
+    def test_report(self):
+        source = (
+            "def test(self):\n"
+            "    x = 'ş'; self.assertTrue(x == y)\n"
+            "    self.failUnless(\n"
+            "        'ğ' in y,\n"
+            "    )\n"
+            "    self.assertFalse(x is None, 'ğğ')\n"
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            base = Path(tmp)
+            (base / "test_a.py").write_text(source, encoding="utf-8")
+            (base / "test_b.py").write_text("self.assertEqual(x, y)\n")
+
+            reports = {}
+            for report_format in ("json", "sarif"):
+                collected_stats = []
+                stdout, stderr = io.StringIO(), io.StringIO()
+                with mock.patch.object(teyit, "_STATS_HOOKS", []), redirect_stdout(
+                    stdout
+                ), redirect_stderr(stderr):
+                    teyit.register_stats_hook(collected_stats.append)
+                    exit_code = teyit._refactor_files(
+                        [base],
+                        pattern="test_*.py",
+                        cache=False,
+                        report=report_format,
+                        show_stats=True,
+                    )
+                self.assertEqual(exit_code, 0)
+                self.assertIn("1 would be reformatted", stderr.getvalue())
+                reports[report_format] = json.loads(stdout.getvalue())
+
+                [stats] = collected_stats
+                self.assertEqual(
+                    [(rule["from"], rule["to"]) for rule in stats["rules"]],
+                    [("failUnless", "assertIn"), ("assertFalse", "assertIsNotNone")],
+                )
+                self.assertFalse(
+                    {"tokenize", "unparse", "splice", "write"} & stats["phases"].keys()
+                )
+
+            self.assertEqual((base / "test_a.py").read_text(encoding="utf-8"), source)
+
+        path = str(base / "test_a.py")
+        self.assertEqual(
+            reports["json"],
+            {
+                "findings": [
+                    {
+                        "path": path,
+                        "line": 3,
+                        "column": 5,
+                        "end_line": 5,
+                        "end_column": 6,
+                        "rule": "failUnless",
+                        "replacement": "assertIn",
+                    },
+                    {
+                        "path": path,
+                        "line": 6,
+                        "column": 5,
+                        "end_line": 6,
+                        "end_column": 38,
+                        "rule": "assertFalse",
+                        "replacement": "assertIsNotNone",
+                    },
+                ]
+            },
+        )
+
+        [run] = reports["sarif"]["runs"]
+        self.assertEqual(reports["sarif"]["version"], "2.1.0")
+        self.assertEqual(
+            [rule["id"] for rule in run["tool"]["driver"]["rules"]],
+            ["assertFalse", "failUnless"],
+        )
+        self.assertEqual(
+            [
+                (
+                    result["ruleId"],
+                    result["locations"][0]["physicalLocation"]["region"],
+                )
+                for result in run["results"]
+            ],
+            [
+                (
+                    "failUnless",
+                    {"startLine": 3, "startColumn": 5, "endLine": 5, "endColumn": 6},
+                ),
+                (
+                    "assertFalse",
+                    {"startLine": 6, "startColumn": 5, "endLine": 6, "endColumn": 38},
+                ),
+            ],
+        )
+        self.assertEqual(
+            run["results"][0]["locations"][0]["physicalLocation"]["artifactLocation"],
+            {"uri": Path(path).as_uri()},
+        )
+
+    def test_shards(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            base = Path(tmp, "tests")
+            base.mkdir()
+            for index in range(20):
+                (base / f"test_{index}.py").write_text(
+                    "self.assertTrue(x == y)\n" if index % 2 else "x = 1\n"
+                )
+
+            shard_files, stats_files = [], []
+            for index in range(1, 4):
+                stats_file = Path(tmp, f"stats-{index}.json")
+                stdout = io.StringIO()
+                # The files are sharded by their paths relative to the current
+                # directory, which keeps the split the same on every run.
+                current_dir = os.getcwd()
+                os.chdir(tmp)
+                try:
+                    with redirect_stdout(stdout):
+                        teyit._refactor_files(
+                            [Path("tests")],
+                            pattern="test_*.py",
+                            cache=False,
+                            check=True,
+                            shard=(index, 3),
+                            stats_out=stats_file,
+                        )
+                finally:
+                    os.chdir(current_dir)
+                shard_files.append(
+                    {
+                        line.split()[-1]
+                        for line in stdout.getvalue().splitlines()
+                        if line.startswith("would reformat")
+                    }
+                )
+                stats_files.append(str(stats_file))
+
+            self.assertTrue(all(shard_files))
+            self.assertEqual(sum(map(len, shard_files)), 10)
+            self.assertEqual(
+                set().union(*shard_files),
+                {f"tests/test_{index}.py" for index in range(1, 20, 2)},
+            )
+
+            stdout, stderr = io.StringIO(), io.StringIO()
+            with redirect_stdout(stdout), redirect_stderr(stderr), self.assertRaises(
+                SystemExit
+            ) as context:
+                teyit.main(["merge-stats", "--stats-format", "json", *stats_files])
+            self.assertEqual(context.exception.code, 0)
+            self.assertEqual(stderr.getvalue(), "")
+            merged_stats = json.loads(stdout.getvalue())
+            self.assertEqual(merged_stats["files"]["total"], 20)
+            self.assertEqual(merged_stats["files"]["reformatted"], 10)
+            self.assertEqual(
+                [(rule["from"], rule["count"]) for rule in merged_stats["rules"]],
+                [("assertTrue", 10)],
+            )
+
+            stdout, stderr = io.StringIO(), io.StringIO()
+            with redirect_stdout(stdout), redirect_stderr(stderr), self.assertRaises(
+                SystemExit
+            ):
+                teyit.main(["merge-stats", *stats_files[:2]])
+            self.assertIn("missing shards 3/3", stderr.getvalue())
+            partial_count = len(shard_files[0]) + len(shard_files[1])
+            self.assertIn(
+                f"{partial_count} assertions (in {partial_count} files)",
+                stdout.getvalue(),
+            )
+
+    def test_io_threads(self):
+        original_read_file = teyit._read_file
+        original_write_atomic = teyit._write_atomic
+
+        def read_file(*args, **kwargs):
+            time.sleep(0.05)
+            return original_read_file(*args, **kwargs)
+
+        def write_atomic(*args, **kwargs):
+            time.sleep(0.05)
+            return original_write_atomic(*args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            base = Path(tmp)
+            for index in range(16):
+                (base / f"test_{index}.py").write_text(
+                    "self.assertTrue(x == y)\n" if index % 2 else "x = 1\n"
+                )
+
+            stdout = io.StringIO()
+            with mock.patch.object(teyit, "_read_file", read_file), mock.patch.object(
+                teyit, "_write_atomic", write_atomic
+            ), redirect_stdout(stdout):
+                started = time.perf_counter()
+                teyit._refactor_files(
+                    [base], pattern="test_*.py", cache=False, jobs=1, io_threads=8
+                )
+                duration = time.perf_counter() - started
+
+            # 24 sleeps in a row would take at least 1.2 seconds.
+            self.assertLess(duration, 0.8)
+            self.assertIn("8 reformatted, 8 left unchanged", stdout.getvalue())
+            for index in range(16):
+                self.assertEqual(
+                    (base / f"test_{index}.py").read_text(),
+                    "self.assertEqual(x, y)\n" if index % 2 else "x = 1\n",
+                )
+
+    def test_process_files_streaming(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base = Path(tmp_dir)
+            for index in range(50):
+                (base / f"test_{index}.py").write_text("self.assertTrue(x)\n")
+
+            for jobs in [1, 2]:
+                consumed = []
+
+                def files():
+                    for index in range(50):
+                        consumed.append(index)
+                        yield base / f"test_{index}.py"
+
+                with self.subTest(jobs=jobs):
+                    results = teyit._process_files(files(), jobs=jobs)
+                    self.assertEqual(next(results).path, base / "test_0.py")
+                    self.assertLess(len(consumed), 50)
+                    self.assertEqual(
+                        [result.path.name for result in results],
+                        [f"test_{index}.py" for index in range(1, 50)],
+                    )
+
+    def test_refactor_files_changed_since(self):
+        def git(*args):
+            subprocess.run(
+                [
+                    "git",
+                    "-c",
+                    "user.name=teyit",
+                    "-c",
+                    "user.email=teyit@example.com",
+                    *args,
+                ],
+                cwd=base,
+                check=True,
+                capture_output=True,
+            )
+
+        def run(cwd=".", **kwargs):
+            current_dir = os.getcwd()
+            os.chdir(base / cwd)
+            try:
+                with redirect_stdout(io.StringIO()) as buffer:
+                    teyit._refactor_files(
+                        [Path(".")], pattern="test_*.py", cache=False, **kwargs
+                    )
+            finally:
+                os.chdir(current_dir)
+            return buffer.getvalue()
+
+        source = "self.assertTrue(x == y)\n"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base = Path(tmp_dir)
+            for name in ("test_committed.py", "test_modified.py", "test_staged.py"):
+                (base / name).write_text("pass\n")
+
+            # Outside of a git repository, everything gets scanned.
+            self.assertIn("3 left unchanged", run(changed_since="HEAD"))
+
+            git("init", "-q")
+            git("add", ".")
+            git("commit", "-q", "-m", "initial")
+            (base / "test_modified.py").write_text(source)
+            (base / "test_staged.py").write_text(source)
+            (base / "test_untracked.py").write_text(source)
+            (base / "untracked.py").write_text(source)
+            git("add", "test_staged.py")
+
+            output = run(staged=True)
+            self.assertIn("reformatted test_staged.py", output)
+            self.assertIn("All done! 1 reformatted", output)
+
+            output = run(changed_since="HEAD")
+            self.assertNotIn("test_staged.py", output)
+            self.assertIn("reformatted test_modified.py", output)
+            self.assertIn("reformatted test_untracked.py", output)
+            self.assertIn("All done! 2 reformatted", output)
+            self.assertEqual((base / "untracked.py").read_text(), source)
+
+            # The paths git reports are relative to the root of the
+            # repository, whatever the current directory is.
+            (base / "sub").mkdir()
+            (base / "sub" / "test_nested.py").write_text(source)
+            output = run(cwd="sub", changed_since="HEAD")
+            self.assertIn("All done! 1 reformatted", output)
+            self.assertEqual(
+                (base / "sub" / "test_nested.py").read_text(),
+                "self.assertEqual(x, y)\n",
+            )
+
+    def test_refactor_files_write_free(self):
+        source = "self.assertTrue(x == y)\n"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base = Path(tmp_dir)
+            for name in ("test_a.py", "test_b.py"):
+                (base / name).write_text(source)
+            (base / "test_clean.py").write_text("pass\n")
+
+            def run(**kwargs):
+                stdout, stderr = io.StringIO(), io.StringIO()
+                with redirect_stdout(stdout), redirect_stderr(stderr):
+                    status = teyit._refactor_files(
+                        [
+                            base / "test_a.py",
+                            base / "test_b.py",
+                            base / "test_clean.py",
+                        ],
+                        pattern="test_*.py",
+                        cache=False,
+                        jobs=1,
+                        **kwargs,
+                    )
+                return status, stdout.getvalue(), stderr.getvalue()
+
+            status, stdout, _ = run(check=True)
+            self.assertEqual(status, 1)
+            self.assertIn(f"would reformat {base / 'test_a.py'}", stdout)
+            self.assertIn(f"would reformat {base / 'test_b.py'}", stdout)
+            self.assertIn("All done! 2 would be reformatted, 1 left unchanged", stdout)
+
+            status, stdout, _ = run(check=True, fail_fast=True)
+            self.assertEqual(status, 1)
+            self.assertIn("test_a.py", stdout)
+            self.assertNotIn("test_b.py", stdout)
+
+            status, stdout, stderr = run(diff=True)
+            self.assertEqual(status, 0)
+            self.assertIn(f"would reformat {base / 'test_a.py'}", stderr)
+            for name in ("test_a.py", "test_b.py"):
+                self.assertIn(
+                    f"--- {base / name}\t(original)\n"
+                    f"+++ {base / name}\t(refactored)\n"
+                    "@@ -1 +1 @@\n"
+                    "-self.assertTrue(x == y)\n"
+                    "+self.assertEqual(x, y)\n",
+                    stdout,
+                )
+
+            for name in ("test_a.py", "test_b.py"):
+                self.assertEqual((base / name).read_text(), source)
+
+    def test_stdin(self):
+        process = subprocess.run(
+            [sys.executable, "-m", "teyit", "-"],
+            input=b"self.assertTrue(x == y)\n",
+            capture_output=True,
+            check=True,
+        )
+        self.assertEqual(process.stdout, b"self.assertEqual(x, y)\n")
+
+        process = subprocess.run(
+            [sys.executable, "-m", "teyit", "--check", "-"],
+            input=b"self.assertTrue(x == y)\n",
+            capture_output=True,
+        )
+        self.assertEqual(process.returncode, 1)
+        self.assertEqual(process.stdout, b"")
+
+        process = subprocess.run(
+            [sys.executable, "-m", "teyit", "--fail-on-change", "-"],
+            input=b"self.assertTrue(x == y)\n",
+            capture_output=True,
+        )
+        self.assertEqual(process.returncode, 1)
+        self.assertEqual(process.stdout, b"self.assertEqual(x, y)\n")
+
+    def start_daemon(self, address):
+        server = teyitd.make_server(address, quiet=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.addCleanup(stop)
+        return server
+
+    def test_daemon(self):
+        server = self.start_daemon(("127.0.0.1", 0))
+        url = f"http://127.0.0.1:{server.server_port}"
+        self.assertTrue(teyit._daemon_is_running(url))
+
+        self.assertEqual(
+            teyit._daemon_refactor(url, b"self.assertTrue(x == y)\n"),
+            (b"self.assertEqual(x, y)\n", [("assertTrue", "assertEqual")]),
+        )
+        self.assertEqual(
+            teyit._daemon_refactor(
+                url, b"self.assertTrue(x == y)\n", frozenset({"assertTrue"})
+            ),
+            (b"self.assertTrue(x == y)\n", []),
+        )
+        self.assertEqual(
+            teyit._daemon_refactor(
+                url, b"self.assertTrue(x == y)\n", scope="testcases"
+            ),
+            (b"self.assertTrue(x == y)\n", []),
+        )
+        with self.assertRaisesRegex(teyit._DaemonError, "400.*SyntaxError"):
+            teyit._daemon_refactor(url, b"self.assertTrue(\n")
+
+        for length in ("five", "-5"):
+            status, _, body = teyit._daemon_request(
+                url, "POST", body=b"", headers={"Content-Length": length}
+            )
+            self.assertEqual((status, body), (400, b"invalid Content-Length\n"))
+
+        # The applied refactorings are aggregated, so that their header stays
+        # short on large (e.g. generated) modules.
+        many_asserts = b"self.assertTrue(x == y)\nself.assertFalse(x is None)\n" * 2000
+        self.assertEqual(
+            teyit._daemon_refactor(url, many_asserts),
+            (
+                b"self.assertEqual(x, y)\nself.assertIsNotNone(x)\n" * 2000,
+                [("assertTrue", "assertEqual")] * 2000
+                + [("assertFalse", "assertIsNotNone")] * 2000,
+            ),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base = Path(tmp_dir)
+            (base / "test_a.py").write_text("self.assertTrue(x == y)\n")
+            (base / "test_b.py").write_text("self.assertIs(x, None)\n")
+            stdout = io.StringIO()
+            with redirect_stdout(stdout), mock.patch.object(
+                teyitd.TeyitHandler,
+                "do_POST",
+                autospec=True,
+                side_effect=teyitd.TeyitHandler.do_POST,
+            ) as do_post:
+                status = teyit._refactor_files(
+                    [base],
+                    pattern="test_*.py",
+                    cache=False,
+                    daemon=url,
+                    stats_format="json",
+                )
+            self.assertEqual(status, 0)
+            self.assertEqual(do_post.call_count, 2)
+            self.assertEqual(
+                (base / "test_a.py").read_text(), "self.assertEqual(x, y)\n"
+            )
+            self.assertEqual((base / "test_b.py").read_text(), "self.assertIsNone(x)\n")
+            self.assertIn('"count": 1', stdout.getvalue())
+
+            # The socket is only created by the server; a missing daemon makes
+            # the CLI fall back to refactoring locally.
+            socket_path = base / "teyitd.sock"
+            missing_url = f"unix:{socket_path}"
+            (base / "test_c.py").write_text("self.assertFalse(x is None)\n")
+            stderr = io.StringIO()
+            with redirect_stdout(io.StringIO()), redirect_stderr(stderr):
+                teyit._refactor_files(
+                    [base / "test_c.py"],
+                    pattern="test_*.py",
+                    cache=False,
+                    daemon=missing_url,
+                )
+            self.assertIn("teyitd is not running", stderr.getvalue())
+            self.assertEqual(
+                (base / "test_c.py").read_text(), "self.assertIsNotNone(x)\n"
+            )
+
+            self.start_daemon(socket_path)
+            self.assertEqual(
+                teyit._daemon_refactor(missing_url, b"self.assertFalse(x in y)\n"),
+                (b"self.assertNotIn(x, y)\n", [("assertFalse", "assertNotIn")]),
+            )
+
+            # Only the sockets that nothing listens on are replaced.
+            with self.assertRaisesRegex(FileExistsError, "another server"):
+                teyitd.make_server(socket_path)
+            stale_path = base / "stale.sock"
+            with socket.socket(socket.AF_UNIX) as stale_socket:
+                stale_socket.bind(str(stale_path))
+            teyitd.make_server(stale_path).server_close()
+            regular_file = base / "test_d.py"
+            regular_file.write_text("pass\n")
+            with self.assertRaisesRegex(FileExistsError, "not a socket"):
+                teyitd.make_server(regular_file)
+            self.assertEqual(regular_file.read_text(), "pass\n")
+
+    def test_watchers(self):
+        watchers = [teyit._PollingWatcher(interval=0.01)]
+        if (inotify_watcher := teyit._InotifyWatcher.create("test_*.py")) is not None:
+            watchers.append(inotify_watcher)
+
+        for watcher in watchers:
+            with self.subTest(
+                watcher=type(watcher).__name__
+            ), tempfile.TemporaryDirectory() as tmp_dir:
+                self.addCleanup(watcher.close)
+                test_file = os.path.join(tmp_dir, "test_a.py")
+                Path(test_file).write_text("self.assertEqual(x, y)\n")
+                watcher.watch([tmp_dir], [test_file])
+
+                Path(test_file).write_text("self.assertTrue(x == y)\n")
+                self.assertEqual(watcher.wait(), ({test_file}, False))
+
+                watcher.watch([tmp_dir], [test_file])
+                Path(tmp_dir, "test_b.py").write_text("self.assertTrue(x)\n")
+                self.assertEqual(watcher.wait(), (set(), True))
+
+    def test_watch(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test_a = Path(tmp_dir, "test_a.py")
+            test_a.write_text("self.assertEqual(x, y)\n")
+            process = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "teyit",
+                    "--watch",
+                    "--no-cache",
+                    "-j1",
+                    "--pattern",
+                    "**/test_*.py",
+                    tmp_dir,
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+            self.addCleanup(process.kill)
+            # Killing the process (if it doesn't start watching in time) ends
+            # the stream, so the loop below can't block forever.
+            startup_timer = threading.Timer(10, process.kill)
+            startup_timer.start()
+            startup_output = []
+            while "Watching" not in (line := process.stderr.readline()):
+                if not line:
+                    self.fail(
+                        "teyit --watch exited before watching:\n"
+                        + "".join(startup_output)
+                    )
+                startup_output.append(line)
+            startup_timer.cancel()
+
+            def wait_for(path, content):
+                deadline = time.monotonic() + 10
+                while time.monotonic() < deadline:
+                    with suppress(OSError):
+                        if path.read_text() == content:
+                            return
+                    time.sleep(0.01)
+                self.fail(f"{path} wasn't refactored")
+
+            test_a.write_text("self.assertTrue(x == y)\n")
+            wait_for(test_a, "self.assertEqual(x, y)\n")
+
+            test_b = Path(tmp_dir, "sub", "test_b.py")
+            test_b.parent.mkdir()
+            test_b.write_text("self.assertTrue(x is None)\n")
+            wait_for(test_b, "self.assertIsNone(x)\n")
+
+            # Give it a chance to (wrongly) pick up its own writes.
+            time.sleep(0.5)
+            process.send_signal(signal.SIGINT)
+            stdout, _ = process.communicate(timeout=10)
+
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(
+            [line for line in stdout.splitlines() if line.startswith("reformatted")],
+            [f"reformatted {test_a}", f"reformatted {test_b}"],
+        )
+        self.assertEqual(stdout.count("All done!"), 3)
+
+    def test_startup(self):
+        # A run where no file changes shouldn't import the rendering
+        # machinery (or anything else that it doesn't need).
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            (Path(tmp_dir) / "test_clean.py").write_text("self.assertEqual(x, y)\n")
+            process = subprocess.run(
+                [
+                    sys.executable,
+                    "-X",
+                    "importtime",
+                    "-c",
+                    (
+                        "import sys, teyit\n"
+                        "sys.argv = ['teyit', '--no-cache', sys.argv[1]]\n"
+                        "try:\n"
+                        "    teyit.main()\n"
+                        "except SystemExit:\n"
+                        "    print(*sorted(sys.modules))"
+                    ),
+                    tmp_dir,
+                ],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+
+        self.assertIn("1 left unchanged", process.stdout)
+        modules = set(process.stdout.splitlines()[-1].split())
+        for module in [
+            "refactor",
+            "refactor.ast",
+            "concurrent.futures",
+            "dataclasses",
+            "difflib",
+            "http.client",
+            "json",
+            "subprocess",
+            "tempfile",
+        ]:
+            self.assertNotIn(module, modules)
+
+        # -X importtime reports "self | cumulative | name" in microseconds.
+        for line in process.stderr.splitlines():
+            self_time, cumulative_time, name = line.split(":", 1)[1].split("|")
+            if name.strip() == "teyit":
+                self.assertLess(int(cumulative_time) / 1e6, IMPORT_TIME_BUDGET)
+                break
+        else:
+            self.fail("teyit wasn't imported")
+
+    def test_refactor_files_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base = Path(tmp_dir)
+            clean_file = base / "test_clean.py"
+            clean_file.write_text("self.assertTrue(x)\n")
+            dirty_file = base / "test_dirty.py"
+            dirty_file.write_text("self.failUnless(x)\n")
+
+            def run():
+                with mock.patch.object(
+                    teyit,
+                    "refactor_until_deterministic",
+                    wraps=teyit.refactor_until_deterministic,
+                ) as refactorer, redirect_stdout(io.StringIO()):
+                    teyit._refactor_files([base], pattern="test_*.py", jobs=1)
+                return refactorer.call_count
+
+            with mock.patch.dict(os.environ, {"TEYIT_CACHE_DIR": tmp_dir + "/cache"}):
+                self.assertEqual(run(), 2)
+                # The freshly reformatted file gets verified once more, and
+                # from there on both of them come from the cache.
+                self.assertEqual(run(), 1)
+                self.assertEqual(run(), 0)
+
+                # Touching the file without changing the content still hits.
+                os.utime(clean_file, ns=(0, 0))
+                self.assertEqual(run(), 0)
+
+                clean_file.write_text("self.assertTrue(x != y)\n")
+                self.assertEqual(run(), 1)
+                self.assertEqual(clean_file.read_text(), "self.assertNotEqual(x, y)\n")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,16 +1,29 @@
 from __future__ import annotations
 
-import argparse
 import ast
-import copy
+import bisect
+import fnmatch
+import hashlib
+import heapq
+import io
+import itertools
+import os
+import pickle
+import re
+import sys
+import time
 import tokenize
-from collections import defaultdict
-from contextlib import suppress
-from dataclasses import dataclass
-from functools import lru_cache
+from collections import Counter, defaultdict, deque, namedtuple
+from contextlib import contextmanager, suppress
+from functools import lru_cache, partial
 from pathlib import Path
 
-from refactor.ast import PreciseUnparser
+# Startup time matters for pre-commit hooks and editor integrations, so
+# anything that isn't needed by a run where no file changes (most notably
+# refactor, which is only needed for rendering the rewrites) is imported
+# on first use.
+
+__version__ = "0.4.3"
 
 OPERATOR_TABLE = {
     ast.Eq: "assertEqual",
@@ -47,53 +60,193 @@ DEPRECATED_ALIASES = {
 }
 
 
-@dataclass
 class Rewrite:
-    node: ast.Call
-    func: str
-    args: list[ast.AST]
+    """A single rewrite of an assertion call. The AST references are only
+    needed until the rewrite gets rendered, after that release() drops them
+    so that what remains (for the statistics) is just the two names."""
+
+    __slots__ = ("node", "func", "args", "original_func", "_new_node")
 
-    def __hash__(self):
-        return hash(id(self))
+    def __init__(self, node, func, args):
+        self.node = node
+        self.func = func
+        self.args = args
+        self.original_func = node.func.attr
+        self._new_node = None
+
+    def __repr__(self):
+        return f"Rewrite({self.original_func!r} => {self.func!r})"
 
-    @lru_cache(maxsize=1)
     def build_node(self):
-        new_node = copy.deepcopy(self.node)
-        new_node.func.attr = self.func
-        new_node.args = self.args
-        return new_node
+        if self._new_node is None:
+            import copy
+
+            # Only the call and its attribute change, the rest of the nodes
+            # can be shared with the original tree.
+            new_node = copy.copy(self.node)
+            new_node.func = copy.copy(self.node.func)
+            new_node.func.attr = self.func
+            new_node.args = self.args
+            self._new_node = new_node
+        return self._new_node
 
-    @lru_cache(maxsize=1)
     def get_arg_offset(self):
-        new_node = self.build_node()
-        prev_args = len(self.node.args + self.node.keywords)
-        return len(new_node.args + new_node.keywords) - prev_args
+        return len(self.args) - len(self.node.args)
+
+    def release(self):
+        self.node = self.args = self._new_node = None
+
+
+def _chained_call(node, func, args):
+    # A shallow intermediate call, only used as the input of the next rule.
+    new_node = ast.Call(
+        func=ast.Attribute(value=node.func.value, attr=func, ctx=ast.Load()),
+        args=args,
+        keywords=node.keywords,
+    )
+    return ast.copy_location(new_node, node)
+
+
+SCOPES = ("module", "classes", "testcases")
+
+
+def _is_test_case(node):
+    for base in node.bases:
+        if isinstance(base, ast.Attribute):
+            name = base.attr
+        else:
+            name = getattr(base, "id", "")
+        if name.endswith("TestCase"):
+            return True
+    return False
+
+
+def _nested_blocks(statement):
+    # The statement lists of a compound statement. Match cases have no
+    # position to prune them by, so their bodies are returned instead (and
+    # the handlers are treated the same way).
+    for field in ("body", "orelse", "finalbody"):
+        yield getattr(statement, field, ())
+    for handler in getattr(statement, "handlers", ()):
+        yield handler.body
+    for case in getattr(statement, "cases", ()):
+        yield case.body
 
 
 class _AssertRewriter(ast.NodeVisitor):
-    def __init__(self, blacklist=frozenset(), *args, **kwargs):
+    max_chain = 5
+
+    # Nodes that are skipped as a whole when none of their lines mention
+    # any of the methods (in the scoped traversal).
+    prunable_nodes = (ast.stmt, ast.List, ast.Tuple, ast.Set, ast.Dict)
+
+    def __init__(
+        self, blacklist=frozenset(), *args, scope="module", source=None, **kwargs
+    ):
         self.asserts = []
         self.blacklist = blacklist
+        self.rules = _active_rules(blacklist)
+        self.scope = scope
+        self.source = source
+        self._candidate_lines = None
         super().__init__(*args, **kwargs)
 
+    def visit_Module(self, node):
+        # By default the whole module is visited. With a narrower scope,
+        # only the methods of the classes (or of the TestCase subclasses)
+        # are, which skips the module level fixtures and helpers.
+        if self.scope == "module":
+            self.generic_visit(node)
+            return None
+
+        if self.source is not None:
+            source = _SourceText.of(self.source)
+            offsets = list(itertools.accumulate(map(len, source.lines), initial=0))
+            self._candidate_lines = sorted(
+                {
+                    bisect.bisect_right(offsets, match.start())
+                    for match in _method_pattern(self.blacklist).finditer(source)
+                }
+            )
+        self._visit_classes(node.body)
+
+    def _may_contain_asserts(self, node):
+        # Whether any of the lines of the node mention one of the methods.
+        if self._candidate_lines is None:
+            return True
+        index = bisect.bisect_left(self._candidate_lines, node.lineno)
+        return (
+            index < len(self._candidate_lines)
+            and self._candidate_lines[index] <= node.end_lineno
+        )
+
+    def _visit_classes(self, body, in_class=False):
+        for statement in body:
+            if not self._may_contain_asserts(statement):
+                continue
+            elif isinstance(statement, ast.ClassDef):
+                if self.scope == "testcases" and not _is_test_case(statement):
+                    continue
+                self._visit_classes(statement.body, in_class=True)
+            elif isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                if in_class:
+                    self._visit_calls(statement)
+            else:
+                # Classes (and methods) might be defined conditionally, e.g.
+                # under an if or a try block.
+                for block in _nested_blocks(statement):
+                    self._visit_classes(block, in_class)
+
+    def _visit_calls(self, node):
+        # Same order as generic_visit(), but without dispatching on each
+        # node (only the calls matter), and without descending into the
+        # constants or into the statements and literals that can't have
+        # any of the calls.
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, ast.Call):
+                self.visit_Call(node)
+                continue
+            elif isinstance(
+                node, self.prunable_nodes
+            ) and not self._may_contain_asserts(node):
+                continue
+            stack.extend(
+                child
+                for child in reversed(list(ast.iter_child_nodes(node)))
+                if not isinstance(child, ast.Constant)
+            )
+
     def visit_Call(self, node):
+        func = node.func
         if not (
-            isinstance(node, ast.Call)
-            and isinstance(node.func, ast.Attribute)
-            and ast.unparse(node.func.value) == "self"
-            and node.func.attr not in self.blacklist
+            isinstance(func, ast.Attribute)
+            and isinstance(func.value, ast.Name)
+            and func.value.id == "self"
+            and func.attr in self.rules
         ):
             return node
-        visitor_proc = f"visit_{node.func.attr}"
-        with suppress(Exception):
-            if node.func.attr in DEPRECATED_ALIASES:
-                self.asserts.append(
-                    Rewrite(node, DEPRECATED_ALIASES[node.func.attr], node.args)
-                )
-            elif not hasattr(self, visitor_proc):
-                return node
-            elif rewrite := getattr(self, visitor_proc)(node):
-                self.asserts.append(rewrite)
+
+        # The result of a rule might be subject to another one (e.g.
+        # failUnless(x == y) => assertTrue(x == y) => assertEqual(x, y)), so
+        # keep applying them on the produced call until it reaches its final
+        # form.
+        rewrite, current_node = None, node
+        for _ in range(self.max_chain):
+            if (rule := self.rules.get(current_node.func.attr)) is None:
+                break
+            try:
+                step = rule(self, current_node)
+            except Exception:
+                step = None
+            if step is None:
+                break
+            rewrite = Rewrite(node, step.func, step.args)
+            current_node = _chained_call(current_node, step.func, step.args)
+
+        if rewrite is not None:
+            self.asserts.append(rewrite)
 
     def visit_assertTrue(self, node, positive=True):
         expr, *args = node.args
@@ -121,7 +274,8 @@ class _AssertRewriter(ast.NodeVisitor):
                 return None
         elif (
             isinstance(expr, ast.Call)
-            and ast.unparse(expr.func) == "isinstance"
+            and isinstance(expr.func, ast.Name)
+            and expr.func.id == "isinstance"
             and len(expr.args) == 2
         ):
             if positive:
@@ -169,84 +323,177 @@ class _AssertRewriter(ast.NodeVisitor):
         return Rewrite(node, func, args)
 
 
-class _FormattedUnparser(PreciseUnparser):
-    def __init__(self, indent_width=4, comments=None, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._is_first_call = True
-        self._indent_text = " " * indent_width
-        self._comments = comments
+def _rename_rule(rewriter, node, *, func):
+    return Rewrite(node, func, node.args)
+
+
+def _collect_rules():
+    rules = {
+        name.removeprefix("visit_"): handler
+        for name, handler in vars(_AssertRewriter).items()
+        # The visitors of the AST nodes themselves (visit_Call etc.) aren't.
+        if name.startswith("visit_") and not hasattr(ast, name.removeprefix("visit_"))
+    }
+    rules.update(
+        (alias, partial(_rename_rule, func=func))
+        for alias, func in DEPRECATED_ALIASES.items()
+    )
+    return rules
+
+
+# Method name => rule (a callable that takes the rewriter and the call, and
+# returns a Rewrite or None).
+RULES = _collect_rules()
+
+
+@lru_cache
+def _active_rules(blacklist=frozenset()):
+    return {name: rule for name, rule in RULES.items() if name not in blacklist}
 
-    def visit_Call(self, node):
-        first_call = self._is_first_call
-        if self._is_first_call:
-            self._is_first_call = False
-        self.set_precedence(ast._Precedence.ATOM, node.func)
-        self.traverse(node.func)
-        self.write("(")
-        self._indent += 1
-
-        total_args = len(node.args + node.keywords)
-        for n, item in enumerate(node.args + node.keywords):
-            add_comma = n + 1 != total_args
-            if first_call:
-                self.fill()
-            self.traverse(item)
-
-            if add_comma:
-                self.write(",")
-            if first_call:
-                if comment := self._comments.get(n):
-                    self.write(f" {comment}")
-            elif add_comma:
-                self.write(" ")
-        self._indent -= 1
-        if first_call:
-            self.fill()
-        self.write(")")
+
+@lru_cache(maxsize=None)
+def _get_unparser():
+    from refactor.ast import PreciseUnparser
+
+    return PreciseUnparser
+
+
+def __getattr__(name):
+    if name == "PreciseUnparser":
+        return _get_unparser()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _slice_line(line, start, end=None):
+    # AST column offsets are UTF-8 byte offsets.
+    if line.isascii():
+        return line[start:end]
+    return line.encode()[start:end].decode()
+
+
+def _source_segment(source, node):
+    lines = source.splitlines()
+    start, end = node.lineno - 1, node.end_lineno - 1
+    if start == end:
+        return _slice_line(lines[start], node.col_offset, node.end_col_offset)
+    return "\n".join(
+        [
+            _slice_line(lines[start], node.col_offset),
+            *lines[start + 1 : end],
+            _slice_line(lines[end], 0, node.end_col_offset),
+        ]
+    )
+
+
+def _render_argument(source, node):
+    # The nodes that come from the original tree are copied from the source
+    # as is, only the ones that are synthesized by the rules (which don't
+    # have any positions) need to be unparsed.
+    if isinstance(node, ast.keyword):
+        prefix = "**" if node.arg is None else f"{node.arg}="
+        return prefix + _render_argument(source, node.value)
+    elif getattr(node, "end_col_offset", None) is not None:
+        return _source_segment(source, node)
+    return _get_unparser()(source=source).unparse(node)
 
 
 def as_source(source, node, *, is_multi_line=False, comments=None, next_indent=4):
     indent = node.col_offset
-    if is_multi_line:
-        formatted_unparser = _FormattedUnparser(
-            source=source, indent_width=next_indent, comments=comments
+    func = f"{_render_argument(source, node.func.value)}.{node.func.attr}"
+    arguments = [_render_argument(source, item) for item in node.args + node.keywords]
+    if not is_multi_line:
+        source = " " * indent + f"{func}({', '.join(arguments)})"
+        if comments is not None and len(comments) >= 1:
+            source += " " + comments.popitem()[1]
+        return source
+
+    # One argument per line, each with its own comment.
+    depth = indent // next_indent
+    lines = [" " * indent + func + "("]
+    for index, argument in enumerate(arguments):
+        line = "    " * (depth + 1) + argument
+        if index + 1 != len(arguments):
+            line += ","
+        if comments is not None and (comment := comments.get(index)):
+            line += f" {comment}"
+        lines.append(line)
+    lines.append("    " * depth + ")")
+    return "\n".join(lines)
+
+
+class _TokenIndex:
+    """Comments and argument lines (the lines of top-level commas and of
+    the last token before the closing paren) of every parenthesized group
+    in a file. The file is tokenized only once, and lazily; only as far
+    as the last rewritten call."""
+
+    def __init__(self, source):
+        self.comments = {}
+        self.groups = {}
+        self._tokens = tokenize.generate_tokens(
+            io.StringIO(source, newline="").readline
         )
-        formatted_unparser._indent = node.col_offset // next_indent
-        source = formatted_unparser.unparse(node)
-    else:
-        regular_unparser = PreciseUnparser(source=source)
-        source = regular_unparser.unparse(node)
+        self._stack = []
+        self._previous_line = 0
+        self._last_line = 0
 
-    source = " " * indent + source
-    if comments is not None and len(comments) >= 1 and not is_multi_line:
-        source += " " + comments.popitem()[1]
-    return source
+    def advance(self, line):
+        if line <= self._last_line:
+            return None
 
+        with suppress(tokenize.TokenError, SyntaxError):
+            for token in self._tokens:
+                self._index_token(token)
+                if token.start[0] > line:
+                    break
+            else:
+                self._last_line = float("inf")
+                return None
+        self._last_line = line
 
-def recover_comments(source_lines):
-    comments, arg_lines = {}, set()
-    with suppress(tokenize.TokenError):
-        nesting = -1
-        tokens = tuple(tokenize.generate_tokens(iter(source_lines).__next__))
-        for index, token in enumerate(tokens):
+    def _index_token(self, token):
+        token_line = token.start[0]
+        if token.type == tokenize.COMMENT:
+            self.comments[token_line] = token.string
+        elif token.type == tokenize.OP:
             if token.string in "([{":
-                nesting += 1
-            elif token.string in ")]}":
-                nesting -= 1
+                self._stack.append((token, set()))
+            elif token.string in ")]}" and self._stack:
+                opener, arg_lines = self._stack.pop()
+                arg_lines.add(self._previous_line)
+                if opener.exact_type == tokenize.LPAR:
+                    opener_line, opener_col = opener.start
+                    if not opener.line.isascii():
+                        opener_col = len(opener.line[:opener_col].encode())
+                    self.groups.setdefault(opener_line, []).append(
+                        (opener_col, arg_lines)
+                    )
+            elif token.exact_type == tokenize.COMMA and self._stack:
+                self._stack[-1][1].add(token_line)
 
-            if nesting == 0 and token.exact_type == tokenize.COMMA:
-                arg_lines.add(token.start[0])
-            elif nesting == -1 and token.exact_type == tokenize.RPAR:
-                arg_lines.add(tokens[index - 1].start[0])
+        if token.type != tokenize.NL:
+            self._previous_line = token_line
 
-            if token.type == tokenize.COMMENT:
-                comments[token.start[0]] = token.string
+    def find_arg_lines(self, node):
+        # The opening paren of the call is the first one after its func.
+        self.advance(node.end_lineno)
+        candidates = [
+            (col, arg_lines)
+            for col, arg_lines in self.groups.get(node.func.end_lineno, ())
+            if col >= node.func.end_col_offset
+        ]
+        if len(candidates) == 0:
+            return set()
+        _, arg_lines = min(candidates, key=lambda candidate: candidate[0])
+        return arg_lines
 
-        return {
-            arg_index: comments[arg_line]
-            for arg_index, arg_line in enumerate(arg_lines)
-            if arg_line in comments
-        }
+
+def recover_comments(token_index, node):
+    return {
+        arg_index: token_index.comments[arg_line]
+        for arg_index, arg_line in enumerate(sorted(token_index.find_arg_lines(node)))
+        if arg_line in token_index.comments
+    }
 
 
 def _adjust_comments(comments, arg_offset):
@@ -258,124 +505,1975 @@ def _adjust_comments(comments, arg_offset):
     return comments
 
 
-def rewrite_source(source, *, blacklist=frozenset()):
-    if len(source) == 0:
-        return source, []
+def _split_lines(source):
+    # Unlike str.splitlines(), only splits on the line endings that Python
+    # itself recognizes (so the line numbers match the AST's), and keeps
+    # them as is.
+    return io.StringIO(source, newline="").readlines()
+
+
+def _line_ending(line):
+    if line.endswith("\r\n"):
+        return "\r\n"
+    elif line.endswith(("\r", "\n")):
+        return line[-1]
+    return ""
+
+
+class _SourceText(str):
+    """Source code that is split into lines only once. The unparser
+    re-splits the whole source on every segment lookup, which would
+    otherwise make each rewrite cost as much as the whole file."""
+
+    @classmethod
+    def of(cls, source):
+        return source if isinstance(source, cls) else cls(source)
+
+    @property
+    def lines(self):
+        if (lines := self.__dict__.get("_lines")) is None:
+            lines = self._lines = _split_lines(self)
+        return lines
+
+    def splitlines(self, keepends=False):
+        if keepends:
+            return self.lines
+        if (lines := self.__dict__.get("_stripped_lines")) is None:
+            lines = self._stripped_lines = [
+                line[: len(line) - len(_line_ending(line))] for line in self.lines
+            ]
+        return lines
+
+
+def _is_standalone(lines, node):
+    # Rewrites replace whole lines, so the call should be the only thing
+    # on them (other than the indentation and a trailing comment).
+    try:
+        first_line = lines[node.lineno - 1].encode()
+        last_line = lines[node.end_lineno - 1].encode()
+    except IndexError:
+        return False
+
+    if first_line[: node.col_offset].strip():
+        return False
+    rest = last_line[node.end_col_offset :].strip()
+    return not rest or rest.startswith(b"#")
+
+
+def _apply_edits(lines, edits):
+    buffer, cursor = [], 0
+    for start, end, replacement, _ in edits:
+        buffer.extend(lines[cursor:start])
+        buffer.append(replacement)
+        cursor = end
+    buffer.extend(lines[cursor:])
+    return "".join(buffer)
+
+
+class _Timings:
+    """Wall time spent in each phase of the refactoring, and
+    on rendering the rewrites of each (old, new) method pair."""
+
+    def __init__(self):
+        self.phases = defaultdict(float)
+        self.rules = defaultdict(float)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+
+class _RenderCache:
+    """Bounded LRU cache of the rendered replacements. Test suites repeat
+    the same assertions a lot, and the replacement of a call only depends
+    on the exact text of its lines (the indentation, the comments and the
+    line endings included) and on the active rules."""
+
+    # Long calls (e.g. with huge literals) are unlikely to repeat.
+    max_key_length = 2048
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._entries = {}
+
+    def get(self, key):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Re-inserting moves the entry to the end, dicts keep the order.
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            # Another thread (in teyitd) might be evicting at the same time.
+            with suppress(KeyError, RuntimeError, StopIteration):
+                del self._entries[next(iter(self._entries))]
 
-    original_source = source
-    tree = ast.parse(source)
-    rewriter = _AssertRewriter(blacklist=blacklist)
-    rewriter.visit(tree)
+    def clear(self):
+        self._entries.clear()
 
-    offset_shift = 0
-    trailing_newline = source[-1] == "\n"
+
+_RENDER_CACHE = _RenderCache()
+
+
+def _compute_edits(source, tree, *, blacklist=frozenset(), timings, scope="module"):
+    # Returns the lines of the source, the (start_line, end_line, replacement,
+    # rule) edits sorted by their position and the applied rewrites.
+    original_source = _SourceText(source)
+    with timings.phase("visit"):
+        rewriter = _AssertRewriter(
+            blacklist=blacklist, scope=scope, source=original_source
+        )
+        rewriter.visit(tree)
+
+    # All replacement spans are calculated against the original lines, and
+    # then spliced together in a single pass.
+    lines = original_source.lines
+    token_index = None
+    edits, rewrites = [], []
     for rewrite in rewriter.asserts:
         node = rewrite.node
-        lines = source.splitlines()  # todo: ast._splitlines_no_ff
-        start, end = (
-            node.lineno - 1 - offset_shift,
-            node.end_lineno - offset_shift,
-        )
-        comments = recover_comments(lines[start:end])
-        new_source = as_source(
-            original_source,
-            rewrite.build_node(),
-            is_multi_line=end - 1 - start,
-            comments=_adjust_comments(comments, rewrite.get_arg_offset()),
+        if not _is_standalone(lines, node):
+            continue
+
+        start, end = node.lineno - 1, node.end_lineno
+        key = blacklist, "".join(lines[start:end])
+        if len(key[1]) > _RenderCache.max_key_length:
+            key = None
+        elif (replacement := _RENDER_CACHE.get(key)) is not None:
+            edits.append((start, end, replacement, rewrite.original_func))
+            rewrites.append(rewrite)
+            rewrite.release()
+            continue
+
+        rule_start = time.perf_counter()
+        with timings.phase("tokenize"):
+            if token_index is None:
+                token_index = _TokenIndex(source)
+            comments = recover_comments(token_index, node)
+        with timings.phase("unparse"):
+            new_source = as_source(
+                original_source,
+                rewrite.build_node(),
+                is_multi_line=end - 1 - start,
+                comments=_adjust_comments(comments, rewrite.get_arg_offset()),
+            )
+        timings.rules[rewrite.original_func, rewrite.func] += (
+            time.perf_counter() - rule_start
         )
-        lines[start:end] = (new_source,)
-        source = "\n".join(lines)
-        if trailing_newline:
-            source += "\n"
-        offset_shift += end - len(new_source.splitlines()) - start
-    return source, rewriter.asserts
+        # The unparser always uses \n, the replaced lines keep their own
+        # line endings.
+        if (newline := _line_ending(lines[start])) not in ("", "\n"):
+            new_source = new_source.replace("\n", newline)
+        replacement = new_source + _line_ending(lines[end - 1])
+        if key is not None:
+            _RENDER_CACHE.put(key, replacement)
+        edits.append((start, end, replacement, rewrite.original_func))
+        rewrites.append(rewrite)
+        rewrite.release()
+
+    edits.sort(key=lambda edit: edit[0])
+    return lines, edits, rewrites
+
+
+def rewrite_source(source, *, blacklist=frozenset(), timings=None, scope="module"):
+    if len(source) == 0:
+        return source, []
+
+    if timings is None:
+        timings = _Timings()
 
+    with timings.phase("parse"):
+        tree = ast.parse(source)
+    lines, edits, rewrites = _compute_edits(
+        source, tree, blacklist=blacklist, timings=timings, scope=scope
+    )
+    if len(edits) == 0:
+        return source, rewrites
+
+    with timings.phase("splice"):
+        new_source = _apply_edits(lines, edits)
+    return new_source, rewrites
 
-def refactor_until_deterministic(source, blacklist=frozenset(), *, max=5):
+
+def refactor_until_deterministic(
+    source, blacklist=frozenset(), *, max=5, timings=None, scope="module"
+):
+    # Rules are already chained within a single pass, so the additional
+    # iterations are only a safety net (e.g. for skipped overlapping calls).
     refactors = []
     for iteration in range(max):
-        source, _refactors = rewrite_source(source, blacklist=blacklist)
+        source, _refactors = rewrite_source(
+            source, blacklist=blacklist, timings=timings, scope=scope
+        )
         if len(_refactors) == 0:
             break
         refactors.extend(_refactors)
     return source, refactors
 
 
-def refactor(self, source, **kwargs):
+def refactor(source, **kwargs):
     source, _ = refactor_until_deterministic(source, **kwargs)
     return source
 
 
-def _glob_files(paths, pattern):
+Edit = namedtuple("Edit", ["start", "end", "replacement", "rule"])
+
+
+def analyze(source, tree=None, *, blacklist=frozenset(), scope="module"):
+    """Return the edits that a single pass of teyit would make on the given
+    source, as Edit(start, end, replacement, rule) tuples sorted by their
+    position. start and end are offsets into the source, and each edit
+    replaces whole lines. rule is the name of the assertion method that
+    was rewritten.
+
+    An already parsed tree of the same source can be given to avoid parsing
+    it again; it is not modified."""
+
+    if len(source) == 0:
+        return []
+    if tree is None:
+        tree = ast.parse(source)
+
+    lines, edits, _ = _compute_edits(
+        source, tree, blacklist=frozenset(blacklist), timings=_Timings(), scope=scope
+    )
+    offsets = list(itertools.accumulate(map(len, lines), initial=0))
+    return [
+        Edit(offsets[start], offsets[end], replacement, rule)
+        for start, end, replacement, rule in edits
+    ]
+
+
+def refactor_many(sources, *, blacklist=frozenset(), scope="module"):
+    """Refactor each of the given sources, and yield the results in order.
+    The rule tables and the rendering machinery are set up once and then
+    shared between all the sources."""
+
+    blacklist = frozenset(blacklist)
+    for source in sources:
+        source, _ = refactor_until_deterministic(
+            source, blacklist=blacklist, scope=scope
+        )
+        yield source
+
+
+_Finding = namedtuple(
+    "_Finding", ["line", "column", "end_line", "end_column", "rule", "replacement"]
+)
+
+
+def _find_rewrites(source, *, blacklist=frozenset(), timings, scope="module"):
+    # The analysis-only counterpart of rewrite_source(), which reports the
+    # calls that a pass would rewrite without rendering any of them. Lines
+    # are 1-based, and the columns are 1-based character offsets.
+    if len(source) == 0:
+        return []
+
+    with timings.phase("parse"):
+        tree = ast.parse(source)
+    source = _SourceText(source)
+    with timings.phase("visit"):
+        rewriter = _AssertRewriter(blacklist=blacklist, scope=scope, source=source)
+        rewriter.visit(tree)
+
+    lines = source.lines
+    findings = []
+    for rewrite in rewriter.asserts:
+        node = rewrite.node
+        if not _is_standalone(lines, node):
+            continue
+        findings.append(
+            _Finding(
+                node.lineno,
+                len(_slice_line(lines[node.lineno - 1], 0, node.col_offset)) + 1,
+                node.end_lineno,
+                len(_slice_line(lines[node.end_lineno - 1], 0, node.end_col_offset))
+                + 1,
+                rewrite.original_func,
+                rewrite.func,
+            )
+        )
+        rewrite.release()
+    return findings
+
+
+def _glob_match(parts, pattern_parts):
+    # Same semantics as Path.glob(), but on a path that is already known.
+    if len(pattern_parts) == 0:
+        return len(parts) == 0
+
+    head, *rest = pattern_parts
+    if head == "**":
+        return any(_glob_match(parts[index:], rest) for index in range(len(parts) + 1))
+    return (
+        len(parts) > 0
+        and fnmatch.fnmatch(parts[0], head)
+        and _glob_match(parts[1:], rest)
+    )
+
+
+def _git(*args):
+    import subprocess
+
+    process = subprocess.run(
+        ["git", *args],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    return process.stdout
+
+
+def _git_changed_files(changed_since=None, staged=False):
+    """Return the absolute paths of the files that have changed in the
+    git repository of the current directory (either since the given
+    revision, or the staged ones), or None if they can't be determined."""
+
+    import subprocess
+
+    try:
+        root = Path(_git("rev-parse", "--show-toplevel").strip())
+        if staged:
+            names = _git("diff", "--name-only", "-z", "--diff-filter=d", "--cached")
+        else:
+            names = _git(
+                "diff", "--name-only", "-z", "--diff-filter=d", changed_since, "--"
+            )
+            names += _git(
+                "ls-files", "-z", "--others", "--exclude-standard", "--full-name"
+            )
+    except (OSError, subprocess.CalledProcessError) as exc:
+        reason = getattr(exc, "stderr", None) or exc
+        print(
+            f"Couldn't get the changed files from git ({str(reason).strip()}),"
+            " falling back to a full scan.",
+            file=sys.stderr,
+        )
+        return None
+    return {root / name for name in names.split("\0") if name}
+
+
+DEFAULT_EXCLUDES = (
+    r"/(\.direnv|\.eggs|\.git|\.hg|\.ipynb_checkpoints|\.mypy_cache|\.nox"
+    r"|\.pytest_cache|\.svn|\.tox|\.venv|__pypackages__|_build|buck-out|build"
+    r"|dist|node_modules|site-packages|venv)/"
+)
+
+
+def _glob_prefix_match(parts, pattern_parts):
+    # Whether anything under the directory with the given parts
+    # could match the pattern.
+    if len(parts) == 0:
+        return True
+    elif len(pattern_parts) <= 1:
+        return len(pattern_parts) == 1 and pattern_parts[0] == "**"
+
+    head, *rest = pattern_parts
+    if head == "**":
+        return True
+    return fnmatch.fnmatch(parts[0], head) and _glob_prefix_match(parts[1:], rest)
+
+
+def _translate_gitignore_segment(segment):
+    regex, index = [], 0
+    while index < len(segment):
+        char = segment[index]
+        if char == "\\" and index + 1 < len(segment):
+            index += 1
+            regex.append(re.escape(segment[index]))
+        elif char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[" and (end := segment.find("]", index + 2)) != -1:
+            content = segment[index + 1 : end].replace("\\", "\\\\")
+            if content.startswith("!"):
+                content = "^" + content[1:]
+            regex.append(f"[{content}]")
+            index = end
+        else:
+            regex.append(re.escape(char))
+        index += 1
+    return "".join(regex)
+
+
+def _parse_gitignore_line(line):
+    """Translate a single .gitignore line into a (regex, negated, dir_only)
+    triple, where the regex matches the paths relative to the directory of
+    the .gitignore file. Returns None for blank lines and comments."""
+
+    line = line.rstrip("\r\n")
+    if line.endswith("\\ "):
+        line = line.rstrip(" ") + " "
+    else:
+        line = line.rstrip(" ")
+    if not line or line.startswith("#"):
+        return None
+
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    elif line.startswith(("\\!", "\\#")):
+        line = line[1:]
+
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+
+    # Patterns with a slash (other than a trailing one) are relative to the
+    # .gitignore file, the rest can match at any level.
+    anchored = "/" in line
+    segments = line.lstrip("/").split("/")
+    regex = [] if anchored else ["(?:.*/)?"]
+    for index, segment in enumerate(segments):
+        is_last = index + 1 == len(segments)
+        if segment == "**":
+            regex.append(".*" if is_last else "(?:.*/)?")
+        else:
+            regex.append(_translate_gitignore_segment(segment))
+            if not is_last:
+                regex.append("/")
+    return re.compile("".join(regex) + r"\Z", re.DOTALL), negated, dir_only
+
+
+class _GitIgnore:
+    """Rules of a single .gitignore file."""
+
+    def __init__(self, directory, rules):
+        self.directory = directory
+        self.rules = rules
+
+    @classmethod
+    def read(cls, directory):
+        try:
+            with open(os.path.join(directory, ".gitignore"), encoding="utf-8") as file:
+                lines = file.readlines()
+        except (OSError, UnicodeDecodeError):
+            return None
+        rules = [rule for line in lines if (rule := _parse_gitignore_line(line))]
+        if len(rules) == 0:
+            return None
+        return cls(directory, rules)
+
+    def match(self, path, is_dir):
+        # The last matching rule wins; None means that no rule matched.
+        relative_path = os.path.relpath(path, self.directory).replace(os.sep, "/")
+        for regex, negated, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative_path):
+                return not negated
+        return None
+
+
+def _is_ignored(ignores, path, is_dir):
+    # Deeper .gitignore files take precedence over the outer ones.
+    for ignore in reversed(ignores):
+        if (ignored := ignore.match(path, is_dir)) is not None:
+            return ignored
+    return False
+
+
+def _outer_gitignores(directory):
+    # The .gitignore files above the given directory, up to the root of its
+    # git repository (if there is one).
+    directory = os.path.abspath(directory)
+    ignores = []
+    while True:
+        parent = os.path.dirname(directory)
+        if os.path.exists(os.path.join(directory, ".git")):
+            return ignores[::-1]
+        elif parent == directory:
+            return []
+        directory = parent
+        if (ignore := _GitIgnore.read(directory)) is not None:
+            ignores.append(ignore)
+
+
+def _is_excluded(excludes, relative_path):
+    return any(exclude.search(relative_path) for exclude in excludes)
+
+
+def _walk_files(root, pattern_parts, excludes=(), gitignore=True, directories=None):
+    """Yield the files under the root directory that match the pattern,
+    pruning the excluded (and ignored) directories while walking. The
+    walked directories are appended to the given directories list."""
+
+    ignores = _outer_gitignores(root) if gitignore else []
+    stack = [(os.fspath(root), (), ignores)]
+    while stack:
+        directory, parts, ignores = stack.pop()
+        if gitignore and (ignore := _GitIgnore.read(directory)) is not None:
+            ignores = [*ignores, ignore]
+        try:
+            with os.scandir(directory) as scanner:
+                entries = sorted(scanner, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        if directories is not None:
+            directories.append(directory)
+
+        subdirectories = []
+        for entry in entries:
+            entry_parts = (*parts, entry.name)
+            relative_path = "/" + "/".join(entry_parts)
+            with suppress(OSError):
+                if entry.is_dir(follow_symlinks=False):
+                    if (
+                        _glob_prefix_match(entry_parts, pattern_parts)
+                        and not _is_excluded(excludes, relative_path + "/")
+                        and not _is_ignored(ignores, entry.path, is_dir=True)
+                    ):
+                        subdirectories.append((entry.path, entry_parts, ignores))
+                elif (
+                    entry.is_file()
+                    and _glob_match(entry_parts, pattern_parts)
+                    and not _is_excluded(excludes, relative_path)
+                    and not _is_ignored(ignores, entry.path, is_dir=False)
+                ):
+                    yield Path(entry.path)
+        stack.extend(reversed(subdirectories))
+
+
+def _glob_files(
+    paths, pattern, changed_files=None, excludes=(), gitignore=True, directories=None
+):
+    pattern_parts = Path(pattern).parts
     for path in paths:
         if path.is_dir():
-            yield from path.glob(pattern)
+            if changed_files is None:
+                yield from _walk_files(
+                    path, pattern_parts, excludes, gitignore, directories
+                )
+                continue
+
+            # Instead of walking the directory, only check the changed
+            # files that are under it.
+            base_dir = path.resolve()
+            for changed_file in sorted(changed_files):
+                with suppress(ValueError):
+                    relative_path = changed_file.relative_to(base_dir)
+                    if _glob_match(
+                        relative_path.parts, pattern_parts
+                    ) and not _is_excluded(excludes, "/" + relative_path.as_posix()):
+                        if changed_file.is_file():
+                            yield path / relative_path
         elif path.is_file():
-            yield path
+            if changed_files is None or path.resolve() in changed_files:
+                yield path
+
+
+def _get_cache_dir():
+    if cache_dir := os.environ.get("TEYIT_CACHE_DIR"):
+        return Path(cache_dir)
+    if xdg_cache_home := os.environ.get("XDG_CACHE_HOME"):
+        base_dir = Path(xdg_cache_home)
+    else:
+        base_dir = Path.home() / ".cache"
+    return base_dir / "teyit" / __version__
+
+
+def _fingerprint(stat_result, data):
+    return (
+        stat_result.st_size,
+        stat_result.st_mtime_ns,
+        hashlib.sha256(data).hexdigest(),
+    )
+
+
+class _Cache:
+    """On-disk record of files that are known to be already clean
+    (teyit wouldn't change them). Each entry maps the absolute path
+    to its (size, mtime, sha256) fingerprint. The cache directory is
+    versioned, and every active rule set gets its own file."""
+
+    def __init__(self, file, entries=None):
+        self.file = file
+        self.entries = entries or {}
+        self.changed = False
+
+    @classmethod
+    def read(cls, blacklist=frozenset(), scope="module"):
+        rule_key = ",".join(sorted(blacklist))
+        if scope != "module":
+            # A file that is clean within a narrower scope might not be
+            # clean for the whole module.
+            rule_key += f";{scope}"
+        rule_key = hashlib.sha256(rule_key.encode()).hexdigest()[:16]
+        cache_file = _get_cache_dir() / f"cache.{rule_key}.pickle"
+        return cls(cache_file, cls._load(cache_file))
+
+    @staticmethod
+    def _load(cache_file):
+        try:
+            with open(cache_file, "rb") as stream:
+                entries = pickle.load(stream)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def is_clean(self, path):
+        key = os.path.abspath(path)
+        if (entry := self.entries.get(key)) is None:
+            return False
+
+        try:
+            stat_result = os.stat(key)
+        except OSError:
+            return False
+
+        size, mtime, digest = entry
+        if stat_result.st_size != size:
+            return False
+        elif stat_result.st_mtime_ns == mtime:
+            return True
+
+        # The file has been touched, but it might still be the same content
+        # (e.g. after a checkout). Verify it through its hash.
+        with suppress(OSError):
+            data = Path(key).read_bytes()
+            if hashlib.sha256(data).hexdigest() == digest:
+                self.mark_clean(key, (size, stat_result.st_mtime_ns, digest))
+                return True
+        return False
+
+    def mark_clean(self, path, fingerprint):
+        self.entries[os.path.abspath(path)] = fingerprint
+        self.changed = True
+
+    def write(self):
+        if not self.changed:
+            return None
+
+        # Other teyit processes might have updated the cache in the meantime,
+        # so merge with the latest version on the disk and then atomically
+        # replace it.
+        import tempfile
+
+        entries = {**self._load(self.file), **self.entries}
+        with suppress(OSError):
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                dir=self.file.parent, delete=False
+            ) as stream:
+                pickle.dump(entries, stream, protocol=pickle.HIGHEST_PROTOCOL)
+            try:
+                os.replace(stream.name, self.file)
+            except OSError:
+                os.unlink(stream.name)
+                raise
+
+
+PHASES = (
+    "discover",
+    "cache",
+    "read",
+    "daemon",
+    "parse",
+    "visit",
+    "tokenize",
+    "unparse",
+    "splice",
+    "write",
+)
 
+_STATS_HOOKS = []
 
-def _show_debug_stats(modified_files, refactors):
-    results = defaultdict(int)
-    for refactor in refactors:
-        results[refactor.node.func.attr, refactor.func] += 1
-    for key, amount in sorted(results.items(), key=lambda kv: kv[1]):
+
+def register_stats_hook(hook):
+    """Register a callable to be called with the statistics (as a
+    JSON-compatible dictionary) at the end of every run."""
+    _STATS_HOOKS.append(hook)
+    return hook
+
+
+class _FileResult:
+    """Picklable summary of a single refactored file, which is
+    what travels back from the worker processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.changed = False
+        self.counters = Counter()
+        self.fingerprint = None
+        self.prefiltered = False
+        self.duration = 0.0
+        self.phases = {}
+        self.rule_timings = {}
+        self.diff = None
+        self.too_large = False
+        self.timed_out = False
+        self.findings = []
+        self.render_cache_hits = 0
+        self.render_cache_misses = 0
+
+
+class _Stats:
+    """Statistics of a whole run, aggregated from the file results."""
+
+    def __init__(self, slowest_files=10):
+        self.files = 0
+        self.modified_files = 0
+        self.prefiltered_files = 0
+        self.cached_files = 0
+        self.too_large_files = 0
+        self.timed_out_files = 0
+        self.render_cache_hits = 0
+        self.render_cache_misses = 0
+        self.counters = Counter()
+        self.timings = _Timings()
+        self.slowest_files = slowest_files
+        self._slowest = []
+
+    def add(self, result):
+        self.prefiltered_files += result.prefiltered
+        self.too_large_files += result.too_large
+        self.timed_out_files += result.timed_out
+        self.render_cache_hits += result.render_cache_hits
+        self.render_cache_misses += result.render_cache_misses
+        if result.changed:
+            self.modified_files += 1
+            self.counters.update(result.counters)
+        for phase, duration in result.phases.items():
+            self.timings.phases[phase] += duration
+        for key, duration in result.rule_timings.items():
+            self.timings.rules[key] += duration
+
+        self._add_slowest(result.duration, str(result.path))
+
+    def merge(self, data):
+        """Add the statistics of another run (in the as_dict() format),
+        e.g. of another shard."""
+
+        files = data["files"]
+        self.files += files["total"]
+        self.modified_files += files["reformatted"]
+        self.prefiltered_files += files["prefiltered"]
+        self.cached_files += files["cached"]
+        self.too_large_files += files.get("too_large", 0)
+        self.timed_out_files += files.get("timed_out", 0)
+        render_cache = data.get("render_cache", {})
+        self.render_cache_hits += render_cache.get("hits", 0)
+        self.render_cache_misses += render_cache.get("misses", 0)
+        for rule in data["rules"]:
+            key = rule["from"], rule["to"]
+            self.counters[key] += rule["count"]
+            self.timings.rules[key] += rule["seconds"]
+        for phase, duration in data["phases"].items():
+            self.timings.phases[phase] += duration
+        for entry in data["slowest_files"]:
+            self._add_slowest(entry["seconds"], entry["path"])
+
+    def _add_slowest(self, duration, path):
+        if len(self._slowest) < self.slowest_files:
+            heapq.heappush(self._slowest, (duration, path))
+        else:
+            heapq.heappushpop(self._slowest, (duration, path))
+
+    def as_dict(self):
+        return {
+            "files": {
+                "total": self.files,
+                "reformatted": self.modified_files,
+                "prefiltered": self.prefiltered_files,
+                "cached": self.cached_files,
+                "too_large": self.too_large_files,
+                "timed_out": self.timed_out_files,
+            },
+            "rules": [
+                {
+                    "from": old,
+                    "to": new,
+                    "count": count,
+                    "seconds": self.timings.rules.get((old, new), 0.0),
+                }
+                for (old, new), count in self.counters.items()
+            ],
+            "render_cache": {
+                "hits": self.render_cache_hits,
+                "misses": self.render_cache_misses,
+            },
+            "phases": {
+                phase: self.timings.phases[phase]
+                for phase in PHASES
+                if phase in self.timings.phases
+            },
+            "slowest_files": [
+                {"path": path, "seconds": duration}
+                for duration, path in sorted(self._slowest, reverse=True)
+            ],
+        }
+
+
+def _show_debug_stats(stats, stats_format="text", stream=None):
+    if stats_format == "json":
+        import json
+
+        print(json.dumps(stats.as_dict(), indent=2), file=stream)
+        return None
+
+    counters = stats.counters
+    for key, amount in sorted(counters.items(), key=lambda kv: kv[1]):
         print(
             "{:25}=> {:25}".format(*key),
             "refactoring happened",
             amount,
             "times.",
+            file=stream,
         )
     print(
-        f"{len(refactors)} assertions (in {modified_files} files) have been refactored."
+        f"{sum(counters.values())} assertions (in {stats.modified_files} files) have"
+        " been refactored.",
+        file=stream,
+    )
+    print(
+        f"{stats.prefiltered_files} files have been skipped without parsing.",
+        file=stream,
+    )
+    print(
+        f"{stats.cached_files} files have been skipped through the cache.", file=stream
     )
+    if stats.too_large_files:
+        print(
+            f"{stats.too_large_files} files have been skipped for being too large.",
+            file=stream,
+        )
+    if stats.timed_out_files:
+        print(
+            f"{stats.timed_out_files} files have been skipped after timing out.",
+            file=stream,
+        )
+
+    if lookups := stats.render_cache_hits + stats.render_cache_misses:
+        print(
+            f"{stats.render_cache_hits} of {lookups} rewrites have been rendered"
+            f" through the cache ({stats.render_cache_hits / lookups:.0%}).",
+            file=stream,
+        )
+
+    print("Time spent on each phase:", file=stream)
+    for phase, duration in stats.as_dict()["phases"].items():
+        print(f"    {phase:25} {duration:.3f}s", file=stream)
+
+    if rule_timings := stats.timings.rules:
+        print("Time spent on rendering each refactoring:", file=stream)
+        for key, duration in sorted(
+            rule_timings.items(), key=lambda kv: kv[1], reverse=True
+        ):
+            print("    {:25}=> {:25}".format(*key), f"{duration:.3f}s", file=stream)
+
+    if slowest_files := stats.as_dict()["slowest_files"]:
+        print("Slowest files:", file=stream)
+        for entry in slowest_files:
+            print(f"    {entry['seconds']:.3f}s {entry['path']}", file=stream)
+
+
+def _show_report(findings, report_format="json"):
+    import json
+
+    if report_format == "sarif":
+        report = _sarif_report(findings)
+    else:
+        report = {
+            "findings": [
+                {"path": str(path), **finding._asdict()} for path, finding in findings
+            ]
+        }
+    print(json.dumps(report, indent=2))
+
+
+def _sarif_report(findings):
+    def location(path, finding):
+        path = Path(path)
+        return {
+            "physicalLocation": {
+                "artifactLocation": {
+                    "uri": path.as_uri() if path.is_absolute() else path.as_posix()
+                },
+                "region": {
+                    "startLine": finding.line,
+                    "startColumn": finding.column,
+                    "endLine": finding.end_line,
+                    "endColumn": finding.end_column,
+                },
+            }
+        }
+
+    rules = sorted({finding.rule for _, finding in findings})
+    return {
+        "$schema": "https://json.schemastore.org/sarif-2.1.0.json",
+        "version": "2.1.0",
+        "runs": [
+            {
+                "tool": {
+                    "driver": {
+                        "name": "teyit",
+                        "version": __version__,
+                        "informationUri": "https://github.com/isidentical/teyit",
+                        "rules": [
+                            {
+                                "id": rule,
+                                "shortDescription": {
+                                    "text": (
+                                        f"self.{rule}() can be replaced with a more"
+                                        " specific assertion"
+                                    )
+                                },
+                            }
+                            for rule in rules
+                        ],
+                    }
+                },
+                "columnKind": "unicodeCodePoints",
+                "results": [
+                    {
+                        "ruleId": finding.rule,
+                        "ruleIndex": rules.index(finding.rule),
+                        "level": "note",
+                        "message": {
+                            "text": (
+                                f"self.{finding.rule}(...) can be replaced with"
+                                f" self.{finding.replacement}(...)"
+                            )
+                        },
+                        "locations": [location(path, finding)],
+                    }
+                    for path, finding in findings
+                ],
+            }
+        ],
+    }
+
+
+@lru_cache
+def _prefilter_pattern(blacklist=frozenset()):
+    # Any file that teyit might change has to mention at least one of the
+    # methods that have an active rule.
+    if len(methods := _active_rules(blacklist)) == 0:
+        return re.compile(rb"(?!)")
+    return re.compile(
+        rb"\b(?:%s)\b" % b"|".join(re.escape(name.encode()) for name in sorted(methods))
+    )
+
+
+@lru_cache
+def _method_pattern(blacklist=frozenset()):
+    # Like _prefilter_pattern(), but for the decoded sources. It is only
+    # used to narrow down the lines to visit, so it doesn't need the word
+    # boundaries (which make the search several times slower).
+    if len(methods := _active_rules(blacklist)) == 0:
+        return re.compile("(?!)")
+    return re.compile("|".join(re.escape(name) for name in sorted(methods)))
+
+
+def _decode_source(data):
+    # The line endings are kept as is (unlike tokenize.open()), so that
+    # they can be written back untouched.
+    encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+    return data.decode(encoding), encoding
+
+
+def _write_atomic(path, data):
+    # Write to a temporary file next to the target and rename it over, so
+    # that the file is never seen (or left, on a crash) half-written.
+    import tempfile
+
+    target = os.path.realpath(path)
+    directory, name = os.path.split(target)
+    mode = os.stat(target).st_mode
+    fd, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as stream:
+            stream.write(data)
+        os.chmod(temp_path, mode & 0o7777)
+        os.replace(temp_path, target)
+    except BaseException:
+        with suppress(OSError):
+            os.unlink(temp_path)
+        raise
+
+
+def _unified_diff(source, refactored_source, name):
+    import difflib
+
+    diff_lines = difflib.unified_diff(
+        _split_lines(source),
+        _split_lines(refactored_source),
+        fromfile=f"{name}\t(original)",
+        tofile=f"{name}\t(refactored)",
+    )
+    return "".join(
+        line if _line_ending(line) else line + "\n\\ No newline at end of file\n"
+        for line in diff_lines
+    )
+
+
+class _DaemonError(Exception):
+    pass
+
+
+def _daemon_request(url, method, body=None, headers=None, timeout=30):
+    import http.client
+
+    # URLs are either http://host:port or unix:/path/to/socket.
+    if url.startswith("unix:"):
+        connection = http.client.HTTPConnection("localhost", timeout=timeout)
+    else:
+        import urllib.parse
+
+        parts = urllib.parse.urlsplit(url)
+        connection = http.client.HTTPConnection(
+            parts.hostname, parts.port, timeout=timeout
+        )
+    try:
+        if url.startswith("unix:"):
+            import socket
+
+            connection.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.sock.settimeout(timeout)
+            connection.sock.connect(url[len("unix:") :])
+        connection.request(method, "/", body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, response.headers, response.read()
+    except OSError as exc:
+        raise _DaemonError(f"teyitd at {url} is not reachable: {exc}") from exc
+    except http.client.HTTPException as exc:
+        raise _DaemonError(
+            f"teyitd at {url} sent an invalid response: {exc!r}"
+        ) from exc
+    finally:
+        connection.close()
+
+
+def _daemon_is_running(url):
+    try:
+        status, _, _ = _daemon_request(url, "GET", timeout=1)
+    except _DaemonError:
+        return False
+    return status == 200
+
+
+def _daemon_refactor(url, data, blacklist=frozenset(), max_passes=5, scope="module"):
+    """Refactor the given raw source through teyitd, and return the
+    refactored raw source along with the applied (old, new) pairs."""
+
+    headers = {"X-Teyit-Max-Passes": str(max_passes)}
+    if blacklist:
+        headers["X-Teyit-Ignore"] = ",".join(sorted(blacklist))
+    if scope != "module":
+        headers["X-Teyit-Scope"] = scope
+    status, response_headers, body = _daemon_request(
+        url, "POST", body=data, headers=headers
+    )
+    if status == 204:
+        return data, []
+    elif status != 200:
+        raise _DaemonError(f"teyitd responded with {status}: {body.decode().strip()}")
+
+    refactors = []
+    for entry in response_headers.get("X-Teyit-Refactors", "").split(","):
+        if entry:
+            pair, _, count = entry.rpartition("=")
+            refactors.extend([tuple(pair.split(":", 1))] * int(count))
+    return body, refactors
+
+
+def _refactor_source(
+    source,
+    data,
+    encoding,
+    *,
+    blacklist,
+    timings,
+    daemon=None,
+    max_passes=5,
+    scope="module",
+):
+    # Returns the refactored source, along with the (old, new) pairs of
+    # the applied rules. Whenever the daemon can't handle a source (e.g.
+    # it went away, or the source is invalid), it is refactored locally
+    # instead, so that the errors are the same in both modes.
+    if daemon is not None:
+        with timings.phase("daemon"), suppress(_DaemonError):
+            refactored_data, refactors = _daemon_refactor(
+                daemon, data, blacklist, max_passes=max_passes, scope=scope
+            )
+            return _decode_source(refactored_data)[0], refactors
+
+    refactored_source, refactors = refactor_until_deterministic(
+        source, blacklist=blacklist, max=max_passes, timings=timings, scope=scope
+    )
+    return refactored_source, [
+        (refactor.original_func, refactor.func) for refactor in refactors
+    ]
+
+
+class _FileTimeout(BaseException):
+    # Not an Exception, so that it can't be swallowed by the rules.
+    pass
+
+
+@contextmanager
+def _time_limit(seconds):
+    # Interrupts the block with _FileTimeout after the given number of seconds.
+    # This needs SIGALRM, so it is a no-op on platforms without it and
+    # outside of the main thread (e.g. in teyitd's request handlers). The
+    # signal is only handled between Python bytecodes, so a single long call
+    # into C (e.g. ast.parse on a huge file) runs to completion before the
+    # file is given up on.
+    import signal
+    import threading
+
+    if (
+        seconds is None
+        or not hasattr(signal, "setitimer")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        yield
+        return
+
+    def on_timeout(signum, frame):
+        raise _FileTimeout
+
+    previous_handler = signal.signal(signal.SIGALRM, on_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def _read_file(path, *, blacklist=frozenset(), cache=False, max_file_size=None):
+    # Returns the stat result (only when caching, or with a size budget), the
+    # raw bytes, and the decoded (source, encoding) pair. Files over the size
+    # budget aren't even read (so they have no raw bytes), and the ones that
+    # don't mention any of the methods are rejected on their raw bytes,
+    # before getting decoded (or parsed); those don't have a decoded source.
+    stat_result = os.stat(path) if cache or max_file_size is not None else None
+    if max_file_size is not None and stat_result.st_size > max_file_size:
+        return stat_result, None, None
+    with open(path, "rb") as stream:
+        data = stream.read()
+    if not _prefilter_pattern(blacklist).search(data):
+        return stat_result, data, None
+    return stat_result, data, _decode_source(data)
 
 
 def _refactor_file(path, **kwargs):
-    with tokenize.open(path) as file:
-        source = file.read()
-        encoding = file.encoding
-    refactored_source, refactors = refactor_until_deterministic(source, **kwargs)
+    start = time.perf_counter()
+    result = _FileResult(path)
+    timings = _Timings()
+    cache_hits, cache_misses = _RENDER_CACHE.hits, _RENDER_CACHE.misses
+    try:
+        _refactor_file_contents(path, result, timings, **kwargs)
+    finally:
+        result.duration = time.perf_counter() - start
+        result.render_cache_hits = _RENDER_CACHE.hits - cache_hits
+        result.render_cache_misses = _RENDER_CACHE.misses - cache_misses
+        result.phases = dict(timings.phases)
+        result.rule_timings = dict(timings.rules)
+    return result
+
+
+def _refactor_file_contents(
+    path,
+    result,
+    timings,
+    *,
+    blacklist=frozenset(),
+    cache=False,
+    write=True,
+    diff=False,
+    daemon=None,
+    max_file_size=None,
+    timeout=None,
+    report=False,
+    scope="module",
+    read=None,
+    writer=None,
+):
+    # The file might have already been read ahead, in which case read is
+    # the future of _read_file().
+    with timings.phase("read"):
+        if read is None:
+            read_result = _read_file(
+                path, blacklist=blacklist, cache=cache, max_file_size=max_file_size
+            )
+        else:
+            read_result = read.result()
+    stat_result, data, decoded = read_result
+    if data is None:
+        result.too_large = True
+        return None
+    elif decoded is None:
+        result.prefiltered = True
+        if cache:
+            result.fingerprint = _fingerprint(stat_result, data)
+        return None
+    source, encoding = decoded
+
+    # The files that go over the time budget are left as is.
+    try:
+        with _time_limit(timeout):
+            if report:
+                findings = _find_rewrites(
+                    source, blacklist=blacklist, timings=timings, scope=scope
+                )
+            else:
+                refactored_source, refactors = _refactor_source(
+                    source,
+                    data,
+                    encoding,
+                    blacklist=blacklist,
+                    timings=timings,
+                    daemon=daemon,
+                    scope=scope,
+                )
+    except _FileTimeout:
+        result.timed_out = True
+        return None
+
+    if report:
+        result.findings = findings
+        if findings:
+            result.changed = True
+            result.counters.update(
+                (finding.rule, finding.replacement) for finding in findings
+            )
+        elif cache:
+            result.fingerprint = _fingerprint(stat_result, data)
+        return None
+
     if refactored_source != source:
-        path.write_text(refactored_source, encoding=encoding)
-    return refactors
-
-
-def _refactor_files(paths, pattern, show_stats=False, fail_on_change=False):
-    modified_files, total_refactors = 0, []
-    files = tuple(_glob_files(paths, pattern=pattern))
-    for path in files:
-        if len(refactors := _refactor_file(path)) > 0:
-            modified_files += 1
-            total_refactors.extend(refactors)
-            print(f"reformatted {path}")
-
-    if len(files) > 0:
-        message = ["All done!"]
-        if modified_files > 0:
-            message.append(f" {modified_files} reformatted")
-        if (left := len(files) - modified_files) > 0:
-            if len(message) > 1:
-                message.append(",")
-            message.append(f" {left} left unchanged")
-        print("".join(message))
-        if fail_on_change and modified_files > 0:
-            return 1
+        if diff:
+            result.diff = _unified_diff(source, refactored_source, path)
+        if write:
+            with timings.phase("write"):
+                (writer or _write_atomic)(path, refactored_source.encode(encoding))
+        result.changed = True
+    elif cache:
+        result.fingerprint = _fingerprint(stat_result, data)
+    result.counters.update(refactors)
+
+
+def _refactor_paths(paths, io_threads=0, **kwargs):
+    # With I/O threads, the files are read (and decoded) ahead while the
+    # previous ones are being refactored, and written back in the
+    # background. Both sides are bounded, so at most a few files are kept
+    # in memory. The workers call this once per chunk, so there the first
+    # file of each chunk (and all of the single file chunks at the start of
+    # a run) can't overlap with anything.
+    if not io_threads:
+        for path in paths:
+            yield _refactor_file(path, **kwargs)
+        return None
+
+    from concurrent.futures import ThreadPoolExecutor
+    from concurrent.futures import wait as wait_futures
+
+    depth = io_threads * 2
+    pool = ThreadPoolExecutor(io_threads, thread_name_prefix="teyit-io")
+    reads, writes = deque(), deque()
+
+    def writer(path, data):
+        while writes and (len(writes) >= depth or writes[0].done()):
+            writes.popleft().result()
+        writes.append(pool.submit(_write_atomic, path, data))
+
+    def read_ahead():
+        for path in paths:
+            reads.append(
+                (
+                    path,
+                    pool.submit(
+                        _read_file,
+                        path,
+                        blacklist=kwargs.get("blacklist", frozenset()),
+                        cache=kwargs.get("cache", False),
+                        max_file_size=kwargs.get("max_file_size"),
+                    ),
+                )
+            )
+            if len(reads) > depth:
+                yield reads.popleft()
+        while reads:
+            yield reads.popleft()
+
+    try:
+        for path, read in read_ahead():
+            yield _refactor_file(path, read=read, writer=writer, **kwargs)
+        while writes:
+            writes.popleft().result()
+    finally:
+        # The pending writes always finish (even if the consumer stops
+        # early), the reads that are no longer needed are dropped.
+        wait_futures(writes)
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _refactor_chunk(paths, **kwargs):
+    return list(_refactor_paths(paths, **kwargs))
+
+
+def _chunks(iterable, jobs, max_size=16):
+    # Start with single files (so that even small runs are spread across all
+    # the workers, and the first results show up right away), and then grow
+    # the chunks to amortize the cost of the IPC on the larger runs.
+    iterator = iter(iterable)
+    size, count = 1, 0
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+        count += 1
+        if count % jobs == 0:
+            size = min(size * 2, max_size)
+
+
+def _process_files(files, jobs=None, **kwargs):
+    # Files are consumed while they are still being discovered, with only a
+    # bounded number of chunks in flight. Results are always yielded in the
+    # order of the given files, no matter which worker finishes first, so
+    # that the output stays stable.
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    # Look ahead just enough to know whether it is worth starting the workers.
+    files = iter(files)
+    head = list(itertools.islice(files, jobs))
+    jobs = min(jobs, len(head))
+    files = itertools.chain(head, files)
+    if jobs > 1:
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+
+            executor = ProcessPoolExecutor(max_workers=jobs)
+        except (ImportError, NotImplementedError, OSError):
+            # Platforms without working multiprocessing primitives (e.g.
+            # AWS Lambda) fall back to the sequential mode.
+            pass
+        else:
+            try:
+                pending = deque()
+                for chunk in _chunks(files, jobs):
+                    pending.append(executor.submit(_refactor_chunk, chunk, **kwargs))
+                    while pending and (len(pending) > jobs * 2 or pending[0].done()):
+                        yield from pending.popleft().result()
+                while pending:
+                    yield from pending.popleft().result()
+            finally:
+                # If the consumer stops early (e.g. --fail-fast), don't wait
+                # for the rest of the files.
+                executor.shutdown(wait=True, cancel_futures=True)
+            return
+    yield from _refactor_paths(files, **kwargs)
+
+
+def _refactor_stdin(
+    blacklist=frozenset(),
+    check=False,
+    diff=False,
+    daemon=None,
+    scope="module",
+    fail_on_change=False,
+):
+    data = sys.stdin.buffer.read()
+    source, encoding = _decode_source(data)
+    refactored_source, _ = _refactor_source(
+        source,
+        data,
+        encoding,
+        blacklist=blacklist,
+        timings=_Timings(),
+        daemon=daemon,
+        scope=scope,
+    )
+    if diff:
+        sys.stdout.write(_unified_diff(source, refactored_source, "STDIN"))
+    elif not check:
+        sys.stdout.flush()
+        sys.stdout.buffer.write(refactored_source.encode(encoding))
+        sys.stdout.buffer.flush()
+    return int((check or fail_on_change) and refactored_source != source)
+
+
+def _refactor_files(
+    paths,
+    pattern,
+    show_stats=False,
+    fail_on_change=False,
+    jobs=None,
+    cache=True,
+    blacklist=frozenset(),
+    stats_format=None,
+    changed_since=None,
+    staged=False,
+    check=False,
+    diff=False,
+    fail_fast=False,
+    daemon=None,
+    excludes=(re.compile(DEFAULT_EXCLUDES),),
+    gitignore=True,
+    max_file_size=None,
+    timeout=None,
+    report=None,
+    shard=None,
+    stats_out=None,
+    scope="module",
+    io_threads=0,
+):
+    if report is not None:
+        # Only teyit itself can do the analysis, the daemon just refactors.
+        daemon = None
+    if daemon is not None and not _daemon_is_running(daemon):
+        print(
+            f"teyitd is not running at {daemon}, refactoring locally.",
+            file=sys.stderr,
+        )
+        daemon = None
+    if daemon is not None:
+        # The daemon does the heavy lifting, there is no point in
+        # spawning worker processes just to forward the files.
+        jobs = 1
+
+    if any(str(path) == "-" for path in paths):
+        return _refactor_stdin(
+            blacklist,
+            check=check,
+            diff=diff,
+            daemon=daemon,
+            scope=scope,
+            fail_on_change=fail_on_change,
+        )
+
+    # In the write-free modes (and with the JSON stats), the status messages
+    # go to stderr so that stdout only has the diff, the report or the stats.
+    write = not (check or diff or report)
+    status_stream = (
+        sys.stderr if diff or report or stats_format == "json" else sys.stdout
+    )
+    stats = _Stats()
+    with stats.timings.phase("discover"):
+        changed_files = None
+        if changed_since is not None or staged:
+            changed_files = _git_changed_files(changed_since, staged=staged)
+        files = _glob_files(
+            paths,
+            pattern=pattern,
+            changed_files=changed_files,
+            excludes=excludes,
+            gitignore=gitignore,
+        )
+    with stats.timings.phase("cache"):
+        file_cache = _Cache.read(blacklist, scope) if cache else None
+
+    def pending_files():
+        # The files are streamed into the workers as they are discovered,
+        # so the whole list is never materialized.
+        while True:
+            with stats.timings.phase("discover"):
+                path = next(files, None)
+            if path is None:
+                return None
+            if shard is not None and _shard_of(path, shard[1]) != shard[0] - 1:
+                continue
+
+            stats.files += 1
+            if file_cache is not None:
+                with stats.timings.phase("cache"):
+                    is_clean = file_cache.is_clean(path)
+                if is_clean:
+                    stats.cached_files += 1
+                    continue
+            yield path
+
+    results = _process_files(
+        pending_files(),
+        jobs=jobs,
+        cache=cache,
+        blacklist=blacklist,
+        write=write,
+        diff=diff,
+        daemon=daemon,
+        max_file_size=max_file_size,
+        timeout=timeout,
+        report=report is not None,
+        scope=scope,
+        io_threads=io_threads,
+    )
+    processed_files = 0
+    findings = []
+    for result in results:
+        processed_files += 1
+        stats.add(result)
+        findings.extend((result.path, finding) for finding in result.findings)
+        if result.changed:
+            if result.diff is not None:
+                sys.stdout.write(result.diff)
+            if write:
+                print(f"reformatted {result.path}", file=status_stream)
+            else:
+                print(f"would reformat {result.path}", file=status_stream)
+            if fail_fast and not write:
+                results.close()
+                break
+        elif result.timed_out:
+            print(
+                f"skipped {result.path} (took longer than {timeout}s)",
+                file=status_stream,
+            )
+        elif result.too_large:
+            print(
+                f"skipped {result.path} (larger than {max_file_size} bytes)",
+                file=status_stream,
+            )
+        elif result.fingerprint is not None:
+            file_cache.mark_clean(result.path, result.fingerprint)
+
+    if file_cache is not None:
+        file_cache.write()
+    if report is not None:
+        _show_report(findings, report)
+
+    modified_files = stats.modified_files
+    if stats.files > 0:
+        message = []
+        if modified_files > 0 and write:
+            message.append(f"{modified_files} reformatted")
+        elif modified_files > 0:
+            message.append(f"{modified_files} would be reformatted")
+        left = (
+            stats.cached_files
+            + processed_files
+            - modified_files
+            - stats.timed_out_files
+            - stats.too_large_files
+        )
+        if left > 0:
+            message.append(f"{left} left unchanged")
+        if stats.timed_out_files > 0:
+            message.append(f"{stats.timed_out_files} timed out")
+        if stats.too_large_files > 0:
+            message.append(f"{stats.too_large_files} too large")
+        print("All done! " + ", ".join(message), file=status_stream)
     else:
-        print("Nothing to refactor!")
+        print("Nothing to refactor!", file=status_stream)
+
+    if show_stats or stats_format is not None:
+        stats_stream = sys.stderr if diff or report else sys.stdout
+        _show_debug_stats(stats, stats_format or "text", stream=stats_stream)
+    for hook in _STATS_HOOKS:
+        hook(stats.as_dict())
+    if stats_out is not None:
+        import json
+
+        Path(stats_out).write_text(
+            json.dumps({**stats.as_dict(), "shard": shard}, indent=2) + "\n"
+        )
+
+    if (fail_on_change or check) and modified_files > 0:
+        return 1
+    return 0
+
+
+def _stat_signature(path):
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    return stat_result.st_mtime_ns, stat_result.st_size, stat_result.st_ino
+
+
+class _PollingWatcher:
+    """Finds the changes by comparing the stats of the files (and of the
+    directories, for the added or removed entries) between the polls."""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._files = self._directories = {}
+
+    def watch(self, directories, files):
+        self._directories = {path: _stat_signature(path) for path in directories}
+        self._files = {path: _stat_signature(path) for path in files}
+
+    def wait(self):
+        # Returns the paths of the changed files, and whether the
+        # directories need to be discovered again.
+        while True:
+            time.sleep(self.interval)
+            changed = {
+                path
+                for path, signature in self._files.items()
+                if _stat_signature(path) != signature
+            }
+            rediscover = any(
+                _stat_signature(path) != signature
+                for path, signature in self._directories.items()
+            )
+            if changed or rediscover:
+                return changed, rediscover
+
+    def close(self):
+        pass
+
+
+class _InotifyWatcher:
+    """Same as _PollingWatcher, but through inotify(7) (Linux only)."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    EVENTS = (
+        IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_DELETE_SELF
+        | IN_MOVE_SELF
+    )
+
+    # Editors tend to save in a few steps, which are batched together.
+    settle_time = 0.05
 
-    if show_stats:
-        _show_debug_stats(modified_files, total_refactors)
+    def __init__(self, pattern):
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._name_pattern = Path(pattern).name
+        self._watches = {}
+        self._files = set()
+
+    @classmethod
+    def create(cls, pattern):
+        try:
+            return cls(pattern)
+        except (OSError, AttributeError):
+            # Not on Linux (or the inotify limits are exhausted).
+            return None
+
+    def watch(self, directories, files):
+        self._files = set(files)
+        directories = {
+            *directories,
+            *(os.path.dirname(path) or os.curdir for path in files),
+        }
+        watched = {directory: wd for wd, directory in self._watches.items()}
+        for directory in watched.keys() - directories:
+            self._libc.inotify_rm_watch(self._fd, watched[directory])
+            del self._watches[watched[directory]]
+        for directory in directories - watched.keys():
+            wd = self._libc.inotify_add_watch(
+                self._fd,
+                os.fsencode(directory),
+                self.EVENTS | self.IN_ONLYDIR,
+            )
+            if wd >= 0:
+                self._watches[wd] = directory
+
+    def _read_events(self, timeout=None):
+        import select
+        import struct
+
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return
+        buffer = os.read(self._fd, 64 * 1024)
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = struct.unpack_from("iIII", buffer, offset)
+            name = buffer[offset + 16 : offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            yield wd, mask, os.fsdecode(name)
+
+    def wait(self):
+        changed, rediscover = set(), False
+        timeout = None
+        while events := list(self._read_events(timeout)):
+            for wd, mask, name in events:
+                if mask & self.IN_IGNORED:
+                    self._watches.pop(wd, None)
+                    continue
+                elif mask & (
+                    self.IN_Q_OVERFLOW
+                    | self.IN_ISDIR
+                    | self.IN_DELETE_SELF
+                    | self.IN_MOVE_SELF
+                ):
+                    rediscover = True
+                    continue
+                elif wd not in self._watches:
+                    continue
+
+                path = os.path.normpath(os.path.join(self._watches[wd], name))
+                if path in self._files:
+                    changed.add(path)
+                elif name == ".gitignore" or (
+                    mask & (self.IN_CREATE | self.IN_MOVED_TO)
+                    and fnmatch.fnmatch(name, self._name_pattern)
+                ):
+                    rediscover = True
+            if not (changed or rediscover):
+                # Nothing relevant (e.g. some other file), keep waiting.
+                timeout = None
+            else:
+                timeout = self.settle_time
+        return changed, rediscover
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _watch(
+    paths,
+    pattern,
+    *,
+    excludes=(re.compile(DEFAULT_EXCLUDES),),
+    gitignore=True,
+    interval=0.5,
+    **options,
+):
+    # The first run goes over all the files, and the following ones only
+    # over the files that changed since then. The discovered files and the
+    # stats of the files after each run are kept in memory, so that the
+    # files that teyit itself wrote aren't picked up again.
+    def discover():
+        directories = []
+        files = _glob_files(
+            paths,
+            pattern,
+            excludes=excludes,
+            gitignore=gitignore,
+            directories=directories,
+        )
+        files = [os.path.normpath(path) for path in files]
+        return files, [os.path.normpath(path) for path in directories]
+
+    def run(files):
+        if files:
+            _refactor_files([Path(path) for path in files], pattern, **options)
+        for path in files:
+            signatures[path] = _stat_signature(path)
+
+    watcher = _InotifyWatcher.create(pattern) or _PollingWatcher(interval)
+    signatures = {}
+    files, directories = discover()
+    try:
+        run(files)
+        watcher.watch(directories, files)
+        print("Watching for changes (press Ctrl+C to stop)", file=sys.stderr)
+        while True:
+            changed, rediscover = watcher.wait()
+            if rediscover:
+                files, directories = discover()
+                for path in signatures.keys() - set(files):
+                    del signatures[path]
+                changed = set(files)
+            run(
+                [
+                    path
+                    for path in files
+                    if path in changed
+                    and (signature := _stat_signature(path)) is not None
+                    and signature != signatures.get(path)
+                ]
+            )
+            watcher.watch(directories, files)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+
+def _shard_of(path, count):
+    # Stable across runs and machines (unlike hash()), as long as the paths
+    # are the same relative to the working directory.
+    import zlib
+
+    with suppress(ValueError):
+        path = os.path.relpath(path)
+    return zlib.crc32(Path(path).as_posix().encode()) % count
+
+
+def _shard(value):
+    import argparse
+
+    index, _, count = value.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = 0
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            f"invalid shard: {value!r} (should be i/n, with 1 <= i <= n)"
+        )
+    return index, count
+
+
+def _merge_stats(argv):
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(
+        prog="teyit merge-stats",
+        description="Combine the --stats-out files of multiple shards.",
+    )
+    parser.add_argument("files", type=Path, nargs="+", help="Files to combine")
+    parser.add_argument(
+        "--stats-format",
+        choices=["text", "json"],
+        default="text",
+        help="Output format of the combined stats",
+    )
+    options = parser.parse_args(argv)
+
+    stats = _Stats()
+    shards = Counter()
+    for file in options.files:
+        try:
+            data = json.loads(file.read_text())
+            stats.merge(data)
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            parser.error(f"can't read the stats from {file}: {exc!r}")
+        if data.get("shard") is not None:
+            shards[tuple(data["shard"])] += 1
+
+    counts = {count for _, count in shards}
+    if len(counts) > 1:
+        print(f"warning: mixed shard counts {sorted(counts)}", file=sys.stderr)
+    for count in counts:
+        if missing := set(range(1, count + 1)) - {i for i, n in shards if n == count}:
+            missing = ", ".join(f"{index}/{count}" for index in sorted(missing))
+            print(f"warning: missing shards {missing}", file=sys.stderr)
+    if duplicates := [shard for shard, amount in shards.items() if amount > 1]:
+        duplicates = ", ".join(f"{index}/{count}" for index, count in duplicates)
+        print(f"warning: duplicate shards {duplicates}", file=sys.stderr)
+
+    _show_debug_stats(stats, options.stats_format)
     return 0
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("paths", type=Path, nargs="*")
+def _rule_list(value):
+    import argparse
+
+    rules = {rule.strip() for rule in value.split(",") if rule.strip()}
+    if unknown_rules := rules.difference(RULES):
+        raise argparse.ArgumentTypeError(
+            f"unknown rule(s): {', '.join(sorted(unknown_rules))}"
+        )
+    return rules
+
+
+def _file_size(value):
+    import argparse
+
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    size = value.strip().upper().removesuffix("B")
+    try:
+        if size[-1:] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid size: {value!r} (e.g. 500000, 512K or 2M)"
+        )
+
+
+def _regex(value):
+    import argparse
+
+    try:
+        return re.compile(value)
+    except re.error as exc:
+        raise argparse.ArgumentTypeError(f"invalid regular expression: {exc}")
+
+
+def _get_blacklist(select=None, ignore=None):
+    blacklist = set()
+    if select:
+        blacklist.update(RULES.keys() - set().union(*select))
+    if ignore:
+        blacklist.update(*ignore)
+    return frozenset(blacklist)
+
+
+def main(argv=None):
+    import argparse
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["merge-stats"]:
+        raise SystemExit(_merge_stats(argv[1:]))
+
+    parser = argparse.ArgumentParser(
+        epilog=(
+            "Use 'teyit merge-stats FILE...' to combine the --stats-out files of"
+            " multiple shards."
+        )
+    )
+    parser.add_argument(
+        "paths",
+        type=Path,
+        nargs="*",
+        help=(
+            "Files or directories to refactor, or - to read a single source from"
+            " stdin and write the result to stdout"
+        ),
+    )
     parser.add_argument(
         "--pattern",
         default="test_*.py",
         help="Wildcard pattern for capturing test files.",
     )
+    parser.add_argument(
+        "--exclude",
+        type=_regex,
+        default=DEFAULT_EXCLUDES,
+        metavar="REGEX",
+        help=(
+            "Regular expression of the paths to skip while walking the"
+            " directories (defaults to the usual virtualenv, build and VCS"
+            " directories)"
+        ),
+    )
+    parser.add_argument(
+        "--extend-exclude",
+        type=_regex,
+        metavar="REGEX",
+        help="Like --exclude, but adds to the default excludes instead",
+    )
+    parser.add_argument(
+        "--no-gitignore",
+        dest="gitignore",
+        action="store_false",
+        help="Don't skip the files ignored by .gitignore files",
+    )
     parser.add_argument(
         "--show-stats",
         action="store_true",
@@ -386,8 +2484,195 @@ def main():
         action="store_true",
         help="Exit with status code 1 if any file changed",
     )
-    options = parser.parse_args()
-    raise SystemExit(_refactor_files(**vars(options)))
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of parallel worker processes (defaults to the CPU count)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="Don't read or write the cache of already clean files",
+    )
+    parser.add_argument(
+        "--select",
+        type=_rule_list,
+        action="append",
+        metavar="RULES",
+        help=(
+            "Comma separated list of rules (the names of the assertion methods"
+            " they rewrite, e.g. assertTrue) to enable, instead of all of them"
+        ),
+    )
+    parser.add_argument(
+        "--ignore",
+        type=_rule_list,
+        action="append",
+        metavar="RULES",
+        help="Comma separated list of rules to disable",
+    )
+    parser.add_argument(
+        "--stats-format",
+        choices=["text", "json"],
+        help=(
+            "Output format of the stats (implies --show-stats). With json, the"
+            " stats are the only output on stdout"
+        ),
+    )
+    git_options = parser.add_mutually_exclusive_group()
+    git_options.add_argument(
+        "--changed-since",
+        metavar="REF",
+        help=(
+            "Only refactor the files that changed (or are untracked) since the"
+            " given git revision"
+        ),
+    )
+    git_options.add_argument(
+        "--staged",
+        action="store_true",
+        help="Only refactor the files that are staged in git",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help=(
+            "Don't write the files back, just exit with status code 1 if any"
+            " file would change"
+        ),
+    )
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="Don't write the files back, print a diff of the changes instead",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="With --check, stop at the first file that would change",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=0,
+        metavar="N",
+        help=(
+            "Number of threads (in each worker) that read the files ahead and"
+            " write them back, while the others are being refactored (e.g. for"
+            " network file systems; defaults to 0, no read-ahead). With multiple"
+            " jobs, the files are only read ahead within each batch that a"
+            " worker gets"
+        ),
+    )
+    parser.add_argument(
+        "--scope",
+        choices=SCOPES,
+        default="module",
+        help=(
+            "Where to look for the assertions: the whole module (the default),"
+            " only the methods of the classes, or only the methods of the"
+            " classes that subclass a *TestCase"
+        ),
+    )
+    parser.add_argument(
+        "--report",
+        choices=["json", "sarif"],
+        help=(
+            "Don't change any files, print the assertions that would be rewritten"
+            " in the given format instead"
+        ),
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=_file_size,
+        metavar="SIZE",
+        help=(
+            "Leave the files larger than this (in bytes, or with a K/M suffix) as"
+            " they are, without reading them"
+        ),
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help=(
+            "Leave the files that take longer than this to refactor as they are"
+            " (checked between the steps of the refactoring, so a single slow"
+            " parse isn't interrupted)"
+        ),
+    )
+    parser.add_argument(
+        "--shard",
+        type=_shard,
+        metavar="I/N",
+        help=(
+            "Only refactor the I-th of N deterministic partitions of the files"
+            " (e.g. 2/4), to split the work across multiple machines"
+        ),
+    )
+    parser.add_argument(
+        "--stats-out",
+        type=Path,
+        metavar="FILE",
+        help=(
+            "Write the stats (as JSON) to the given file, which can be combined"
+            " with the ones of the other shards through 'teyit merge-stats'"
+        ),
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help=(
+            "Keep running, and refactor the files again whenever they change"
+            " (until interrupted)"
+        ),
+    )
+    parser.add_argument(
+        "--daemon",
+        metavar="URL",
+        default=os.environ.get("TEYIT_DAEMON") or None,
+        help=(
+            "Forward the sources to a running teyitd (http://host:port or"
+            " unix:/path/to/socket; defaults to $TEYIT_DAEMON), and fall back to"
+            " refactoring locally if it isn't running"
+        ),
+    )
+    options = vars(parser.parse_args(argv))
+    if options["fail_fast"] and not options["check"]:
+        parser.error("--fail-fast can only be used with --check")
+    if any(str(path) == "-" for path in options["paths"]) and len(options["paths"]) > 1:
+        parser.error("'-' (stdin) can't be combined with other paths")
+    if options["jobs"] is not None and options["jobs"] < 1:
+        parser.error("--jobs should be at least 1")
+    if options["io_threads"] < 0:
+        parser.error("--io-threads can't be negative")
+    if options["timeout"] is not None and options["timeout"] <= 0:
+        parser.error("--timeout should be positive")
+    if options["report"] and options["diff"]:
+        parser.error("--report can't be combined with --diff")
+    if options["report"] and any(str(path) == "-" for path in options["paths"]):
+        parser.error("--report can't be used with '-' (stdin)")
+    if (
+        options["show_stats"] or options["stats_format"] or options["stats_out"]
+    ) and any(str(path) == "-" for path in options["paths"]):
+        parser.error("the stats options can't be used with '-' (stdin)")
+    if options["watch"] and (
+        options["changed_since"]
+        or options["staged"]
+        or any(str(path) == "-" for path in options["paths"])
+    ):
+        parser.error("--watch can't be combined with stdin or the git options")
+    options["blacklist"] = _get_blacklist(options.pop("select"), options.pop("ignore"))
+    options["excludes"] = tuple(
+        exclude
+        for exclude in (options.pop("exclude"), options.pop("extend_exclude"))
+        if exclude is not None
+    )
+    if options.pop("watch"):
+        raise SystemExit(_watch(**options))
+    raise SystemExit(_refactor_files(**options))
 
 
 if __name__ == "__main__":
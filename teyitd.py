@@ -0,0 +1,225 @@
+"""A long running teyit server.
+
+Editor integrations and pre-commit hooks would otherwise pay for a new
+interpreter (and for importing teyit and its dependencies) on every
+invocation. ``teyitd`` keeps all of that warm, and refactors the sources
+that are POST'ed to it. The ``teyit`` CLI forwards to it when it is given
+``--daemon URL`` (or ``TEYIT_DAEMON``).
+
+Request:  POST / with the raw bytes of the source as the body, and
+          optionally ``X-Teyit-Select`` / ``X-Teyit-Ignore`` headers with
+          comma separated rule names (same as the CLI options), and
+          ``X-Teyit-Max-Passes`` to limit the number of passes and
+          ``X-Teyit-Scope`` to narrow down the scope (see ``--scope``).
+Response: 200 with the refactored source (in the same encoding), 204 if
+          the source wouldn't change, 400 if the source or the options are
+          invalid and 500 on any other error. ``X-Teyit-Refactors`` lists
+          the applied refactorings as comma separated ``old:new=count``
+          entries (one per distinct pair, so that it stays short no matter
+          how many assertions were rewritten).
+
+A GET request to / returns the version, and can be used as a health check.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import teyit
+
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 45490
+
+
+class TeyitHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = f"teyitd/{teyit.__version__}"
+
+    def do_GET(self):
+        self._respond(200, f"teyitd {teyit.__version__}\n".encode())
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            return self._respond(400, b"invalid Content-Length\n")
+        data = self.rfile.read(length)
+
+        try:
+            blacklist = teyit._get_blacklist(
+                *(
+                    [teyit._rule_list(value)]
+                    if (value := self.headers.get(name))
+                    else None
+                    for name in ("X-Teyit-Select", "X-Teyit-Ignore")
+                )
+            )
+            max_passes = int(self.headers.get("X-Teyit-Max-Passes", 5))
+            scope = self.headers.get("X-Teyit-Scope", "module")
+            if scope not in teyit.SCOPES:
+                raise ValueError(f"unknown scope: {scope!r}")
+            source, encoding = teyit._decode_source(data)
+            refactored_source, refactors = teyit.refactor_until_deterministic(
+                source, blacklist=blacklist, max=max_passes, scope=scope
+            )
+        except (argparse.ArgumentTypeError, SyntaxError, ValueError) as exc:
+            return self._respond(400, f"{type(exc).__name__}: {exc}\n".encode())
+        except Exception as exc:
+            self.log_error("unexpected error: %r", exc)
+            return self._respond(500, f"{type(exc).__name__}: {exc}\n".encode())
+
+        if refactored_source == source:
+            return self._respond(204)
+        self._respond(
+            200,
+            refactored_source.encode(encoding),
+            {
+                "Content-Type": f"text/x-python; charset={encoding}",
+                "X-Teyit-Refactors": ",".join(
+                    f"{old}:{new}={count}"
+                    for (old, new), count in Counter(
+                        (refactor.original_func, refactor.func)
+                        for refactor in refactors
+                    ).items()
+                ),
+            },
+        )
+
+    def _respond(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if status != 204:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and status != 204:
+            self.wfile.write(body)
+
+    def address_string(self):
+        # Clients of a unix socket don't have an address.
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class TeyitServer(ThreadingHTTPServer):
+    daemon_threads = True
+    quiet = False
+
+
+class UnixTeyitServer(TeyitServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind() would try to resolve the host name.
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def _remove_stale_socket(path):
+    # A socket left behind by a daemon that didn't shut down cleanly would
+    # make the bind fail, so it is removed; but only when nothing listens on
+    # it anymore, and never if the path is anything other than a socket.
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists and is not a socket")
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass
+        else:
+            raise FileExistsError(f"another server is listening on {path}")
+    os.unlink(path)
+
+
+def make_server(address, *, quiet=False):
+    """Create a server for the given ``(host, port)`` pair, or for the
+    given path of a unix socket."""
+
+    if isinstance(address, (str, os.PathLike)):
+        path = os.fspath(address)
+        _remove_stale_socket(path)
+        server = UnixTeyitServer(path, TeyitHandler)
+    else:
+        server = TeyitServer(address, TeyitHandler)
+    server.quiet = quiet
+    return server
+
+
+def _warm_up():
+    # Fill the rule tables and the caches of the rendering machinery
+    # before the first real request comes in.
+    teyit._prefilter_pattern()
+    teyit._get_unparser()
+    teyit.refactor_until_deterministic("self.assertTrue(x == y)\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="teyitd", description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--bind-host",
+        default=DEFAULT_HOST,
+        help=f"Address to listen on (defaults to {DEFAULT_HOST})",
+    )
+    parser.add_argument(
+        "--bind-port",
+        type=int,
+        default=DEFAULT_PORT,
+        help=f"Port to listen on (defaults to {DEFAULT_PORT})",
+    )
+    parser.add_argument(
+        "--unix-socket",
+        metavar="PATH",
+        help="Listen on a unix socket at the given path instead of a TCP port",
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="Don't log the requests"
+    )
+    options = parser.parse_args()
+
+    _warm_up()
+    if options.unix_socket:
+        address = options.unix_socket
+        url = f"unix:{os.path.abspath(address)}"
+    else:
+        address = (options.bind_host, options.bind_port)
+        url = f"http://{options.bind_host}:{options.bind_port}"
+
+    try:
+        server = make_server(address, quiet=options.quiet)
+    except OSError as exc:
+        parser.error(f"can't listen on {url}: {exc}")
+    # Exit through the cleanup below (which removes the unix socket) when
+    # the service manager stops the daemon.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"teyitd {teyit.__version__} listening on {url}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if options.unix_socket:
+            os.unlink(options.unix_socket)
+
+
+if __name__ == "__main__":
+    main()